@@ -26,11 +26,12 @@ from datetime import datetime, timezone, timedelta
 import os
 import re
 import sys
-import time
 
 import pandas
 
+import rulestore
 import threatstack
+import tsoutput
 
 
 def get_args():
@@ -121,6 +122,26 @@ def get_args():
         help="Number of days previous to today to get alerts for",
     )
 
+    parser.add_argument(
+        "--rules-snapshot",
+        dest="rules_snapshot",
+        help="Local snapshot of the rulesets and rules, used to add ruleName and rulesetName to each alert. Only rulesets that changed since the last run are fetched again.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--snapshot-max-age-hours",
+        dest="snapshot_max_age",
+        type=float,
+        help="Fetch the rules of a ruleset again once its snapshot is this old, even if it didn't change (default 24).",
+        required=False,
+        default=24,
+    )
+
+    tsoutput.add_output_args(parser)
+    tsoutput.add_archive_args(parser)
+
     cli_args = parser.parse_args()
 
     config_file = cli_args.config_file
@@ -132,10 +153,35 @@ def get_args():
     start = datetime.utcnow() - timedelta(days=numberofdays)
     start_date = cli_args.start_date if cli_args.start_date != "DEFAULT" else datetime.isoformat(start)
     filename = cli_args.filename
+    snapshot_opts = (cli_args.rules_snapshot, cli_args.snapshot_max_age)
+    output_opts = (cli_args.output_format, cli_args.compression, cli_args.rotate_mb)
+    archive_opts = (
+        cli_args.archive_path,
+        cli_args.replay_path,
+        cli_args.cassette_path,
+        cli_args.cassette_mode,
+        cli_args.replay_latency,
+    )
+
+    # The time range comes from the clock, so a replayed run reuses the recorded one
+    # or its URLs would never match the archive or cassette
+    replay_source = cli_args.replay_path
+    if cli_args.cassette_path and cli_args.cassette_mode == "replay":
+        replay_source = cli_args.cassette_path
+    if replay_source and cli_args.start_date == "DEFAULT" and cli_args.end_date == "DEFAULT":
+        recorded = threatstack.recorded_query(replay_source, "alerts")
+        if recorded and "from" in recorded and "until" in recorded:
+            start_date = recorded["from"]
+            end_date = recorded["until"]
+            print(f"Replaying the recorded time range {start_date} to {end_date}")
 
     if not os.path.isfile(filename) and filename != "DEFAULT":
         print("Unable to find file to write to: " + filename + ", exiting.")
         sys.exit(-1)
+
+    if filename != "DEFAULT" and cli_args.output_format == "jsonl":
+        print("--filename only appends to CSV output, it can't be used with --format jsonl, exiting.")
+        sys.exit(-1)
     
     if not os.path.isfile(config_file):
         print("Unable to find config file: " + config_file + ", exiting.")
@@ -181,6 +227,9 @@ def get_args():
         end_date,
         rule_id,
         filename,
+        output_opts,
+        archive_opts,
+        snapshot_opts,
     )
 
 
@@ -249,7 +298,19 @@ def write_out_to_disk(data, status, rule_id, org_name, date, filename, writeHead
 
 
 
-def get_alerts(userid, apikey, orgid, org_name, alert_status, start, end_date, rule_id, filename):
+def add_rule_names(alert, rule_store):
+    """
+    This function returns the alert with the ruleName and rulesetName of its rule
+    Both are left empty if the rule isn't in the snapshot
+    """
+    found = rule_store.get(alert.get("ruleId"))
+    if found is None:
+        return dict(alert, ruleName="", rulesetName="")
+    rule, ruleset = found
+    return dict(alert, ruleName=rule.get("name", ""), rulesetName=ruleset.get("name", ""))
+
+
+def get_alerts(userid, apikey, orgid, org_name, alert_status, start, end_date, rule_id, filename, output_opts=("csv", "gzip", 0), archive_opts=(None, None, None, "replay", None), snapshot_opts=(None, 24)):
     """
     This function is used to get all the alerts for a specfic org and rule id
     This is then writen out to a csv file
@@ -264,17 +325,29 @@ def get_alerts(userid, apikey, orgid, org_name, alert_status, start, end_date, r
     end (date) : date of today
     rule_id (str) : rule id we are processing for
     filename (str): optoinal filename to append to instead of creating a new file
+    output_opts (tuple) : output format, compression and rotation size in MB
+    archive_opts (tuple) : response archive to write to and to replay from, and cassette settings
+    snapshot_opts (tuple) : rules snapshot file and the maximum age of a ruleset in it, in hours
 
     """
+    output_format, compression, rotate_mb = output_opts
+    rules_snapshot, snapshot_max_age = snapshot_opts
     alertstatus = alert_status
     processed_count = 0
     all_alerts = []
     firstTime = True
     date = f"{datetime.utcnow():%Y-%m-%d-%H-%M}"
 
-    uaclient = threatstack.ApiClient(
-        user_id=userid, org_id=orgid, api_key=apikey, retry=5
-    )
+    # The rules snapshot refresh fetches several rulesets at once, so the client is rate limited
+    uaclient = threatstack.open_client(userid, orgid, apikey, 5, *archive_opts, rate_limit=11)
+
+    # Rule names come from the local snapshot, which only refetches changed rulesets
+    rule_store = None
+    if rules_snapshot:
+        rule_store = rulestore.RuleStore(rules_snapshot)
+        refetched = rule_store.refresh(uaclient, snapshot_max_age)
+        rule_store.save()
+        print(f"Rules snapshot: {len(rule_store)} rules, fetched {refetched} of {len(rule_store.rulesets)} rulesets")
     if rule_id is None:
         getliststring = f"alerts?status={alertstatus}&from={start}&until={end_date}"
     else:
@@ -282,17 +355,35 @@ def get_alerts(userid, apikey, orgid, org_name, alert_status, start, end_date, r
         
     print(getliststring)
 
+    sink = None
+    if output_format == "jsonl":
+        if rule_id is None:
+            sink = tsoutput.JsonlSink(f"{org_name}-{alert_status}-{date}", compression, rotate_mb)
+        else:
+            sink = tsoutput.JsonlSink(f"{org_name}-{rule_id}-{alert_status}-{date}", compression, rotate_mb)
+
     alert_list = uaclient.get_list(getliststring)
 
     while alert_list:
         # print(alert_list.data)
         print("Adding alert", start, end_date, processed_count)
 
-        for alert in alert_list.data:
+        alerts = alert_list.data
+        if rule_store is not None:
+            alerts = [add_rule_names(alert, rule_store) for alert in alerts]
+
+        for alert in alerts:
             processed_count += 1
             all_alerts.append(alert)
 
-        write_out_to_disk(alert_list.data, alert_status, rule_id, org_name, date, filename, firstTime)
+        if sink is not None:
+            print(f"Writing alerts: {len(alerts)}, Rule status: {alert_status}")
+            sink.write_many(
+                alert for alert in alerts
+                if rule_id is None or alert["ruleId"] == rule_id
+            )
+        else:
+            write_out_to_disk(alerts, alert_status, rule_id, org_name, date, filename, firstTime)
         firstTime = False
 
         if alert_list.token:
@@ -302,16 +393,21 @@ def get_alerts(userid, apikey, orgid, org_name, alert_status, start, end_date, r
                 querystring = f"alerts?status={alertstatus}&ruleId={rule_id}&from={start}&until={end_date}&token={alert_list.token}"
 
             alert_list = uaclient.get_list(querystring)
-            time.sleep(0.09)
 
         else:
             alert_list = None
 
+    print("API metrics: " + str(uaclient.metrics))
+
+    if sink is not None:
+        sink.close()
+        print("Wrote " + str(sink.records) + " alerts to " + ", ".join(sink.files))
+
 
 def main():
 
     # Call get_args and get set the values for next function calls
-    user_id, api_key, org_id, org_name, alert_status, start, end, rule_id, filename = get_args()
+    user_id, api_key, org_id, org_name, alert_status, start, end, rule_id, filename, output_opts, archive_opts, snapshot_opts = get_args()
 
     # Print out the ags
     print_parsed_args(
@@ -320,7 +416,7 @@ def main():
 
     # Now go call getalerts to do it's api calls
     get_alerts(
-        user_id, api_key, org_id, org_name, alert_status, str(start), str(end), rule_id, filename
+        user_id, api_key, org_id, org_name, alert_status, str(start), str(end), rule_id, filename, output_opts, archive_opts, snapshot_opts
     )
 
 
@@ -0,0 +1,159 @@
+#   Copyright (c) 2022 F5, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Local snapshot of the rulesets and rules of a Threat Stack organization
+
+    Rules and suppressions rarely change, so the snapshot is kept in a JSON
+    file and refreshed incrementally: the ruleset listing is fetched on every
+    refresh, but the rules are only fetched again for rulesets that are new,
+    whose listing changed, or whose rules are older than the maximum age.
+
+    File layout:
+        {"fetched": <time of the last refresh>,
+         "rulesets": [{"ruleset": <ruleset as listed>,
+                       "fetched": <time its rules were fetched>,
+                       "rules": [<rule>, ...]}, ...]}
+"""
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def get_rulesets(uaclient):
+    """
+    Return every ruleset of the org, following the page tokens
+    """
+    rulesets = []
+    ruleset_list = uaclient.get_list("rulesets")
+    while ruleset_list:
+        rulesets.extend(ruleset_list.data)
+        if ruleset_list.token:
+            ruleset_list = uaclient.get_list("rulesets", "", ruleset_list.token)
+        else:
+            ruleset_list = None
+    return rulesets
+
+
+def get_rules(uaclient, ruleset_id):
+    """
+    Return every rule of a ruleset, in the order the API lists them,
+    following the page tokens
+    """
+    querystring = "rulesets/" + ruleset_id + "/rules"
+    rules = []
+    rule_list = uaclient.get_list(querystring)
+    while rule_list:
+        rules.extend(rule_list.data)
+        if rule_list.token:
+            rule_list = uaclient.get_list(querystring, "", rule_list.token)
+        else:
+            rule_list = None
+    return rules
+
+
+class RuleStore:
+    """
+    This class defines the rulesets and rules snapshot of an org
+
+    rulesets holds one {"ruleset", "fetched", "rules"} entry per ruleset, in
+    the order the API lists them. Rules are looked up by id from an in-memory
+    index, so enriching alerts doesn't cost a request per rule.
+    Without a path the store starts empty and is never saved.
+    """
+
+    def __init__(self, path=None):
+        setattr(self, "path", path)
+        setattr(self, "fetched", None)
+        setattr(self, "rulesets", [])
+
+        if path and os.path.isfile(path):
+            with open(path) as f:
+                snapshot = json.load(f)
+            self.fetched = snapshot["fetched"]
+            self.rulesets = snapshot["rulesets"]
+        self._index()
+
+    def _index(self):
+        self._rules = {}
+        for entry in self.rulesets:
+            for rule in entry["rules"]:
+                self._rules[rule["id"]] = (rule, entry["ruleset"])
+
+    def is_stale(self, entry, ruleset, max_age_hours, now):
+        """
+        Return True if the rules of a listed ruleset need to be fetched again
+        """
+        if entry is None or entry["ruleset"] != ruleset:
+            return True
+        if max_age_hours is None:
+            return False
+        return now - entry["fetched"] >= max_age_hours * 3600
+
+    def refresh(self, uaclient, max_age_hours=24, workers=8):
+        """
+        Bring the snapshot up to date with the API and return the number of
+        rulesets whose rules were fetched again
+
+        Rulesets that are no longer listed are dropped. The rules of up to
+        workers rulesets are fetched at once.
+        """
+        now = time.time()
+        previous = {entry["ruleset"]["id"]: entry for entry in self.rulesets}
+        rulesets = get_rulesets(uaclient)
+        stale = [
+            ruleset
+            for ruleset in rulesets
+            if self.is_stale(previous.get(ruleset["id"]), ruleset, max_age_hours, now)
+        ]
+
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(workers, len(stale))) as pool:
+                for ruleset, rules in zip(
+                    stale,
+                    pool.map(lambda ruleset: get_rules(uaclient, ruleset["id"]), stale),
+                ):
+                    previous[ruleset["id"]] = {
+                        "ruleset": ruleset,
+                        "fetched": now,
+                        "rules": rules,
+                    }
+
+        self.rulesets = [previous[ruleset["id"]] for ruleset in rulesets]
+        self.fetched = now
+        self._index()
+        return len(stale)
+
+    def save(self):
+        """
+        Write the snapshot to its file, replacing the previous one in a single step
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"fetched": self.fetched, "rulesets": self.rulesets}, f)
+        os.replace(tmp_path, self.path)
+
+    def get(self, rule_id, default=None):
+        """
+        Return the (rule, ruleset) of a rule id, or default if it isn't known
+        """
+        return self._rules.get(rule_id, default)
+
+    def __contains__(self, rule_id):
+        return rule_id in self._rules
+
+    def __len__(self):
+        return len(self._rules)
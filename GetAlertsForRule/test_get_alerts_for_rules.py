@@ -0,0 +1,108 @@
+#   Copyright (c) 2022 F5, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Record get_alerts_for_rules.py to a cassette and replay it
+
+    The alert time range comes from the clock, so the replay only matches the
+    recording if the recorded range is reused.
+
+    Run from this directory with: python3 -m unittest test_get_alerts_for_rules
+"""
+
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import get_alerts_for_rules
+
+
+CONFIG = """[USER_INFO]
+TS_USER_ID = user
+TS_API_KEY = key
+
+[DEFAULT]
+TS_ORGANIZATION_ID = org
+TS_ORGANIZATION_NAME = Test
+"""
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.status_code = 200
+        self.content = json.dumps(body).encode("utf-8")
+        self.text = self.content.decode("utf-8")
+
+
+def fake_request(method, url, **kwargs):
+    if "token=" in url:
+        return FakeResponse({"alerts": [{"id": "a2", "ruleId": "r1"}], "token": None})
+    return FakeResponse({"alerts": [{"id": "a1", "ruleId": "r1"}], "token": "t1"})
+
+
+def no_request(method, url, **kwargs):
+    raise AssertionError("Replay made a live request to " + url)
+
+
+class CassetteReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        with open("threatstack.cfg", "w") as f:
+            f.write(CONFIG)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def run_alerts(self, *args):
+        argv = ["get_alerts_for_rules.py", "--format", "jsonl", "--compress", "none"]
+        with mock.patch.object(sys, "argv", argv + list(args) + ["1"]):
+            get_alerts_for_rules.main()
+
+        # Runs in the same minute write the same file, so it is read and removed
+        (output,) = glob.glob("Test-active-*.jsonl")
+        with open(output) as f:
+            alerts = [json.loads(line) for line in f]
+        os.remove(output)
+        return alerts
+
+    def test_cassette_replay_matches_recording(self):
+        with mock.patch("requests.Session.request", side_effect=fake_request):
+            recorded = self.run_alerts("--cassette", "run.cas", "--cassette-mode", "record")
+
+        with mock.patch("requests.Session.request", side_effect=no_request):
+            replayed = self.run_alerts("--cassette", "run.cas")
+
+        self.assertEqual([alert["id"] for alert in recorded], ["a1", "a2"])
+        self.assertEqual(replayed, recorded)
+
+    def test_archive_replay_matches_recording(self):
+        with mock.patch("requests.Session.request", side_effect=fake_request):
+            recorded = self.run_alerts("--archive", "responses.arc")
+
+        with mock.patch("requests.Session.request", side_effect=no_request):
+            replayed = self.run_alerts("--replay-archive", "responses.arc")
+
+        self.assertEqual(replayed, recorded)
+
+
+if __name__ == "__main__":
+    unittest.main()
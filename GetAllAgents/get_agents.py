@@ -21,18 +21,63 @@
 """
 
 
-import requests
 import argparse
 import configparser
+import functools
+import ipaddress
+import json
 import os
 import re
 import sys
-import csv
+import threading
 
-from mohawk import Sender
-from pprint import pprint
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
 
+import pandas
+
+import threatstack
+import tsoutput
+
+
+AGENT_STATUSES = ["online", "offline"]
+
+# Address classes, in the order they are checked, then addresses that can't be parsed
+ADDRESS_CLASSES = ["loopback", "link_local", "private", "public", "unparsed"]
+DEFAULT_KEEP_ADDRESSES = ["private", "public", "unparsed"]
+
+# Agent fields the health report groups by
+REPORT_GROUPS = ["agentType", "osVersion", "version", "status"]
+
+# Staleness buckets: (label, upper bound in hours since the agent last reported)
+STALENESS_BUCKETS = [
+    ("<1h", 1),
+    ("1h-24h", 24),
+    ("1d-7d", 24 * 7),
+    ("7d-30d", 24 * 30),
+    (">30d", float("inf")),
+]
+
+# Fixed output schema: (output column, flattened agent key)
+# Column names match the CSV headers this script has always written
+AGENT_COLUMNS = [
+    ("agentId", "id"),
+    ("instanceId", "instanceId"),
+    ("status", "status"),
+    ("CreatedAt", "createdAt"),
+    ("LastReportedAt", "lastReportedAt"),
+    ("version", "version"),
+    ("name", "name"),
+    ("description", "description"),
+    ("hostname", "hostname"),
+    ("ipAddresses", "ipAddresses"),
+    ("tags", "tags"),
+    ("agentType", "agentType"),
+    ("osVersion", "osVersion"),
+    ("kernel", "kernel"),
+    ("isHealthy", "agentModuleHealth"),
+]
+
 
 def get_args():
     """
@@ -68,12 +113,81 @@ def get_args():
         "--debug", action="store_true", help="Enable additional debug CLI logging."
     )
 
+    parser.add_argument(
+        "--status",
+        dest="statuses",
+        nargs="+",
+        choices=AGENT_STATUSES + ["all"],
+        help="Agent statuses to export, fetched concurrently into one output (default online).",
+        required=False,
+        default=["online"],
+    )
+
+    parser.add_argument(
+        "--keep-addresses",
+        dest="keep_addresses",
+        nargs="+",
+        choices=ADDRESS_CLASSES,
+        help="Address classes to keep in ipAddresses (default private public unparsed).",
+        required=False,
+        default=DEFAULT_KEEP_ADDRESSES,
+    )
+
+    parser.add_argument(
+        "--report",
+        dest="report",
+        action="store_true",
+        help="Also write a fleet health report: staleness buckets, version distribution and unhealthy agents per group.",
+        required=False,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--report-by",
+        dest="report_by",
+        choices=REPORT_GROUPS,
+        help="Agent field to group the health report by (default agentType).",
+        required=False,
+        default="agentType",
+    )
+
+    parser.add_argument(
+        "--stale-hours",
+        dest="stale_hours",
+        type=float,
+        help="Agents that haven't reported for this many hours count as stale in the report (default 24).",
+        required=False,
+        default=24,
+    )
+
+    tsoutput.add_output_args(parser, tsoutput.SCHEMA_FORMATS)
+    tsoutput.add_archive_args(parser)
+
     cli_args = parser.parse_args()
 
     config_file = cli_args.config_file
     org_config = cli_args.org_config
     quiet = cli_args.quiet
     debug = cli_args.debug
+    if "all" in cli_args.statuses:
+        statuses = AGENT_STATUSES
+    else:
+        statuses = [s for s in AGENT_STATUSES if s in cli_args.statuses]
+    keep_addresses = frozenset(cli_args.keep_addresses)
+    report_opts = (cli_args.report, cli_args.report_by, cli_args.stale_hours)
+    output_opts = (cli_args.output_format, cli_args.compression, cli_args.rotate_mb)
+    archive_opts = (
+        cli_args.archive_path,
+        cli_args.replay_path,
+        cli_args.cassette_path,
+        cli_args.cassette_mode,
+        cli_args.replay_latency,
+    )
+
+    # --debug replaces every field with a "key:val" string, which the report can't read
+    if cli_args.report and debug:
+        print("--report can't be used with --debug, exiting.")
+        sys.exit(-1)
 
     if not os.path.isfile(config_file):
         print("Unable to find config file: " + config_file + ", exiting.")
@@ -109,185 +223,311 @@ def get_args():
     tmp_org_name = re.sub("[\W_]+", "_", org_opts["TS_ORGANIZATION_NAME"])
     org_name = re.sub("[^A-Za-z0-9]+", "", tmp_org_name)
 
-    return user_id, api_key, org_id, org_name, debug, quiet
+    return (
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        debug,
+        quiet,
+        statuses,
+        keep_addresses,
+        report_opts,
+        output_opts,
+        archive_opts,
+    )
+
+
+@functools.lru_cache(maxsize=65536)
+def classify_address(addr):
+    """
+    Return the class of an address such as 10.0.0.1/8 or fe80::1/64:
+    loopback, link_local, private or public, or unparsed if it can't be parsed
+    Agents on the same networks report the same strings, so results are cached
+    """
+    try:
+        ip = ipaddress.ip_interface(addr).ip
+    except ValueError:
+        return "unparsed"
+    if ip.is_loopback:
+        return "loopback"
+    if ip.is_link_local:
+        return "link_local"
+    if ip.is_private:
+        return "private"
+    return "public"
+
+
+def flatten_agent(agent, debug=False, keep_addresses=DEFAULT_KEEP_ADDRESSES):
+    """
+    This function flattens one agent from the API into the exported fields
+    Only addresses in one of the keep_addresses classes are exported
+    Keys outside the output schema are kept, for the writer to count
+    """
+    agent_info = {}
+    for key, val in agent.items():
+        if key == "ipAddresses":
+            # Classify each address itself rather than trusting the group it's listed under
+            agent_info[key] = [
+                addr
+                for addresses in (val or {}).values()
+                for addr in addresses
+                if classify_address(addr) in keep_addresses
+            ]
+        elif key == "agentModuleHealth":
+            if debug:
+                print(key, ":", val)
+                agent_info[key] = key + ":" + str(val)
+            else:
+                if val is None:
+                    agent_info[key] = ""
+                else:
+                    agent_info[key] = val["isHealthy"]
+        elif debug:
+            print(key, ":", val)
+            agent_info[key] = key + ":" + str(val)
+        else:
+            agent_info[key] = val
+
+    return agent_info
 
 
 def get_agents(
-    credentials,
-    BASE_PATH,
-    org_id,
-    OUTPUT_FILE,
+    tsclient,
+    write_agents,
     debug=False,
     quiet=False,
-    token=None,
+    status="online",
+    keep_addresses=DEFAULT_KEEP_ADDRESSES,
 ):
-    CONTENT_TYPE = "application/json"
-    METHOD = "GET"
+    """
+    This function pages through all agents with the given status and hands
+    each page of flattened agents to write_agents
+
+    Parameters:
+    tsclient (ApiClient) : client to make the requests with
+    write_agents (function) : called with the list of flattened agents in each page
+    debug, quiet (bool) : CLI logging options
+    status (str) : agent status to fetch, online or offline
+    keep_addresses (set) : address classes to keep in ipAddresses
+    """
+    query_string = "?status=" + status
+    agent_list = tsclient.get_list("agents", query_string)
+    if not agent_list.data:
+        print("0 " + status + " agents found.")
+        return
+
+    while agent_list:
+        if not quiet:
+            print(
+                "Returned " + str(len(agent_list.data)) + " " + status + " agents."
+            )
 
-    if token is None:
-        URI_PATH = "agents?status=online"
-    else:
-        URI_PATH = "agents?status=online" + "&token=" + token
+        agents_list = []
+        for agent in agent_list.data:
+            agent_info = flatten_agent(agent, debug, keep_addresses)
+            if agent_info:
+                # Every row says which status it was exported for
+                agent_info.setdefault("status", status)
+                agents_list.append(agent_info)
+        write_agents(agents_list)
 
-    URL = BASE_PATH + URI_PATH
+        if agents_list and not quiet:
+            print(str(len(agents_list)) + " agents written to file.")
 
-    try:
-        sender = Sender(credentials, URL, METHOD, always_hash_content=False, ext=org_id)
-    except:
-        print("Unexpected error:", sys.exc_info()[0])
-        sys.exit(-1)
-
-    response = requests.get(
-        URL,
-        headers={"Authorization": sender.request_header, "Content-Type": CONTENT_TYPE,},
-    )
-    if not response.ok:
-        print("Request returned status: " + str(response.status_code) + ", exiting.")
-        pprint(response)
-        sys.exit(-1)
+        if agent_list.token:
+            if debug:
+                print("Found pagination token.")
+            agent_list = tsclient.get_list("agents", query_string, agent_list.token)
+        else:
+            agent_list = None
 
-    try:
-        agent_json = response.json()
-    except:
-        print("Failed to decode API JSON response, exiting.")
-        pprint(response)
-        sys.exit(-1)
 
-    if not "agents" in agent_json:
-        print(
-            "Malformed JSON object received - expected 'agents' key in response. Exiting."
-        )
-        pprint(agent_json)
-        sys.exit(-1)
+def get_agents_by_status(
+    tsclient,
+    write_agents,
+    statuses,
+    debug=False,
+    quiet=False,
+    keep_addresses=DEFAULT_KEEP_ADDRESSES,
+):
+    """
+    This function pages through each status concurrently on the same client
+    Pages are written as they arrive, one at a time, so only the pages in
+    flight are held in memory
+    """
+    write_lock = threading.Lock()
+
+    def write_page(agents):
+        with write_lock:
+            write_agents(agents)
+
+    with ThreadPoolExecutor(max_workers=len(statuses)) as pool:
+        futures = [
+            pool.submit(
+                get_agents,
+                tsclient,
+                write_page,
+                debug,
+                quiet,
+                status,
+                keep_addresses,
+            )
+            for status in statuses
+        ]
+        for future in futures:
+            future.result()
 
-    agents = agent_json["agents"]
-    num_agents = len(agents)
-    if not num_agents >= 1:
-        print("0 agents found, exiting.")
-        sys.exit()
 
-    if not quiet:
-        print("Returned", num_agents, "agents.")
-
-    AGENT_KEYS = [
-        "id",
-        "instanceId",
-        "status",
-        "createdAt",
-        "lastReportedAt",
-        "version",
-        "name",
-        "description",
-        "hostname",
-        "tags",
-        "agentType",
-        "osVersion",
-        "kernel",
-    ]
-
-    # Write the agents out to the CSV file
-    with open(OUTPUT_FILE, "a") as f:
-        w = csv.writer(f)
-        agents_list = []
-        for agent in agents:
-            agent_info = {}
-            ipAddressList = []
-            for key, val in agent.items():
-                if key == "ipAddresses":
-                    for addrType, ipAddresses in agent["ipAddresses"].items():
-                        # Exclude link_local
-                        if addrType == "private" or addrType == "public":
-                            for addr in ipAddresses:
-                                # Exclude localhost
-                                if addr != "127.0.0.1/8" and addr != "::1/128":
-                                    ipAddressList.append(addr)
-
-                    agent_info[key] = ipAddressList
-                elif key == "agentModuleHealth":
-                    if debug:
-                        print(key, ":", val)
-                        agent_info[key] = key + ":" + str(val)
-                    else:
-                        if val is None:
-                            agent_info[key] = ""
-                        else:
-                            agent_info[key] = val["isHealthy"]
-                else:
-                    if key in AGENT_KEYS:
-                        if debug:
-                            print(key, ":", val)
-                            agent_info[key] = key + ":" + str(val)
-                        else:
-                            agent_info[key] = val
-                    else:
-                        print("Unexpected key,val pair: ", key, val)
+def parse_timestamps(values):
+    """
+    Parse a column of API timestamps into UTC datetimes, with NaT for missing ones
+    The API mixes timestamps with and without milliseconds, which pandas 2
+    only accepts with format="ISO8601"; older versions parse them as they are
+    """
+    if int(pandas.__version__.split(".")[0]) >= 2:
+        return pandas.to_datetime(values, utc=True, errors="coerce", format="ISO8601")
+    return pandas.to_datetime(values, utc=True, errors="coerce")
 
-            if agent_info:
-                agents_list.append(agent_info)
-                w.writerow(agent_info.values())
 
-    if agents_list and not quiet:
-        print(len(agents_list), "agents written to file.")
+class AgentReport(object):
+    """
+    Collects the few agent fields the fleet health report needs, one list
+    per field, so the report is computed over whole columns at the end
+    """
 
-    if "paginationToken" in agent_json:
-        if agent_json["paginationToken"] != None:
-            if debug:
-                print("Found pagination token.")
-            paginationToken = agent_json["paginationToken"]
-            return paginationToken
-        else:
-            return None
+    FIELDS = ["lastReportedAt", "createdAt", "version", "agentModuleHealth"]
+
+    def __init__(self, group_by="agentType"):
+        self.group_by = group_by
+        self.columns = {name: [] for name in self.FIELDS + [group_by]}
+
+    def add_page(self, agents):
+        for name, column in self.columns.items():
+            column.extend([agent.get(name) for agent in agents])
+
+    def build(self, stale_hours=24, now=None):
+        """
+        Return the report as a dict of plain counts
+        """
+        df = pandas.DataFrame(self.columns)
+        if now is None:
+            now = pandas.Timestamp.now(tz="UTC")
+
+        last = parse_timestamps(df["lastReportedAt"])
+        created = parse_timestamps(df["createdAt"])
+        hours = (now - last).dt.total_seconds() / 3600
+
+        labels = [label for label, _ in STALENESS_BUCKETS]
+        buckets = pandas.cut(
+            hours,
+            bins=[float("-inf")] + [bound for _, bound in STALENESS_BUCKETS],
+            labels=labels,
+        )
+        staleness = buckets.value_counts().reindex(labels, fill_value=0)
+
+        df["unhealthy"] = df["agentModuleHealth"].eq(False)
+        df["stale"] = hours.gt(stale_hours) | last.isna()
+        df["ageDays"] = (now - created).dt.total_seconds() / 86400
+        df[self.group_by] = df[self.group_by].fillna("").astype(str)
+
+        groups = df.groupby(self.group_by).agg(
+            agents=("unhealthy", "size"),
+            unhealthy=("unhealthy", "sum"),
+            stale=("stale", "sum"),
+            medianAgeDays=("ageDays", "median"),
+        )
 
-    if "token" in agent_json:
-        if agent_json["token"] != None:
-            if debug:
-                print("Found pagination token.")
-            paginationToken = agent_json["token"]
-            return paginationToken
-        else:
-            return None
-    return None
+        return {
+            "generated": now.isoformat(),
+            "agents": int(len(df)),
+            "unhealthy": int(df["unhealthy"].sum()),
+            "staleHours": stale_hours,
+            "stale": int(df["stale"].sum()),
+            "staleness": dict(
+                {label: int(count) for label, count in staleness.items()},
+                never=int(last.isna().sum()),
+            ),
+            "versions": {
+                str(version): int(count)
+                for version, count in df["version"].value_counts().items()
+            },
+            "by" + self.group_by[0].upper() + self.group_by[1:]: {
+                group: {
+                    "agents": int(row.agents),
+                    "unhealthy": int(row.unhealthy),
+                    "stale": int(row.stale),
+                    "medianAgeDays": None
+                    if pandas.isna(row.medianAgeDays)
+                    else round(float(row.medianAgeDays), 1),
+                }
+                for group, row in groups.iterrows()
+            },
+        }
 
 
 def main():
     timestamp = date.today().isoformat()
-    user_id, api_key, org_id, org_name, debug, quiet = get_args()
-
-    OUTPUT_FILE = "agents" + "-" + org_name + "-" + timestamp + ".csv"
-
-    BASE_PATH = "https://api.threatstack.com/v2/"
-
-    credentials = {"id": user_id, "key": api_key, "algorithm": "sha256"}
-
-    with open(OUTPUT_FILE, "w") as f:
-        w = csv.writer(f)
-
-        # Write header
-        HEADER = [
-            "agentId",
-            "instanceId",
-            "status",
-            "CreatedAt",
-            "LastReportedAt",
-            "version",
-            "name",
-            "description",
-            "hostname",
-            "ipAddresses",
-            "tags",
-            "agentType",
-            "osVersion",
-            "kernel",
-            "isHealthy",
-        ]
-        w.writerow(HEADER)
-
-    token = get_agents(
-        credentials, BASE_PATH, org_id, OUTPUT_FILE, debug, quiet
+    (
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        debug,
+        quiet,
+        statuses,
+        keep_addresses,
+        report_opts,
+        output_opts,
+        archive_opts,
+    ) = get_args()
+    report, report_by, stale_hours = report_opts
+    output_format, compression, rotate_mb = output_opts
+
+    OUTPUT_FILE = "agents" + "-" + org_name + "-" + timestamp
+
+    # One pooled, retrying and rate limited client for every page of every status
+    tsclient = threatstack.open_client(
+        user_id, org_id, api_key, 5, *archive_opts, rate_limit=11
     )
-    while token is not None:
-        token = get_agents(
-            credentials, BASE_PATH, org_id, OUTPUT_FILE, debug, quiet, token
+
+    agent_report = None
+    if report:
+        agent_report = AgentReport(report_by)
+
+    # One writer, kept open for the whole run
+    with tsoutput.SchemaWriter(
+        OUTPUT_FILE, AGENT_COLUMNS, output_format, compression, rotate_mb
+    ) as writer:
+
+        def write_agents(agents):
+            writer.write_many(agents)
+            if agent_report is not None:
+                agent_report.add_page(agents)
+
+        get_agents_by_status(
+            tsclient, write_agents, statuses, debug, quiet, keep_addresses
+        )
+
+    if writer.unexpected:
+        print("Unexpected agent keys (agents seen with each): " + str(writer.unexpected))
+    if not quiet:
+        print("Wrote " + str(writer.records) + " agents to " + ", ".join(writer.files))
+        print("API metrics: " + str(tsclient.metrics))
+
+    if agent_report is not None:
+        REPORT_FILE = "agents-report" + "-" + org_name + "-" + timestamp + ".json"
+        summary = agent_report.build(stale_hours)
+        with open(REPORT_FILE, "w") as f:
+            json.dump(summary, f, indent=2)
+        print(
+            str(summary["agents"])
+            + " agents, "
+            + str(summary["stale"])
+            + " stale, "
+            + str(summary["unhealthy"])
+            + " unhealthy. Report written to "
+            + REPORT_FILE
         )
 
 
@@ -27,202 +27,287 @@
 
 import argparse
 import configparser
+import csv
 import datetime
+import gzip
+import hashlib
+import json
 import os
 import re
 import sys
+import threading
 import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas
 
+import ec2index
 import threatstack
+import tsoutput
+
+
+EC2_QUERIES = {
+    "monitored": "aws/ec2?monitored=true&verbose=true",
+    "unmonitored": "aws/ec2?monitored=false&verbose=true",
+}
+
+# Instance field to partition the inventory by -> aws/ec2 query parameter that filters on it
+PARTITION_PARAMS = {
+    "region": "region",
+    "awsProfile": "awsProfileId",
+}
+
+# Flattened EC2 record schema: (output column, key in the instance object)
+# Column names match the CSV headers this script has always written
+EC2_INSTANCE_COLUMNS = [
+    ("id", "id"),
+    ("kernelId", "kernelId"),
+    ("instanceType", "instanceType"),
+    ("privateDnsName", "privateDnsName"),
+    ("privateIpAddress", "privateIpAddress"),
+    ("group", "groups"),
+    ("subnetId", "subnetId"),
+    ("keyName", "keyName"),
+    ("region", "region"),
+    ("launchTime", "launchTime"),
+    ("imageId", "imageId"),
+    ("architecture", "architecture"),
+    ("publicDnsName", "publicDnsName"),
+    ("publicIpAddress", "publicIpAddress"),
+    ("vpcId", "vpcId"),
+    ("awsProfile", "awsProfile"),
+    ("monitored", "monitored"),
+    ("tags", "tags"),
+    ("state", "state"),
+    ("stateCode", "stateCode"),
+]
+
+# (output column, key in the instance's first agent object)
+EC2_AGENT_COLUMNS = [
+    ("ID", "id"),
+    ("Status", "status"),
+    ("createdAt", "createdAt"),
+    ("lastReportedAt", "lastReportedAt"),
+    ("version", "version"),
+    ("name", "name"),
+    ("description", "description"),
+    ("hostName", "hostname"),
+    ("isContainer", "isContainerAgent"),
+    ("kernel", "kernel"),
+    ("osVersion", "osVersion"),
+]
+
+EC2_COLUMNS = [name for name, _ in EC2_INSTANCE_COLUMNS + EC2_AGENT_COLUMNS]
+
+# JSON lines records use the API's name for the security groups
+JSONL_NAMES = {"group": "groups"}
+
+# Unmonitored instances don't have an agent, so their agent columns are left empty
+NO_AGENT = {}
+
+# Long-format side tables, one row per instance tag and per security group
+TAG_COLUMNS = ["instanceId", "key", "value", "source"]
+GROUP_COLUMNS = ["instanceId", "groupId", "groupName"]
+
+
+class EC2Columns(object):
+    """
+    Column-oriented accumulator for flattened EC2 instances
 
+    Each page of raw instances is added one column at a time, so there are no
+    per-instance Python objects between the API response and the DataFrame.
+    """
 
-class Servers(object):
-    def __init__(
-        self,
-        id,
-        kernelId,
-        instanceType,
-        privateDnsName,
-        privateIpAddress,
-        group,
-        subnetId,
-        keyName,
-        region,
-        launchTime,
-        imageId,
-        architecture,
-        publicDnsName,
-        publicIpAddress,
-        vpcId,
-        awsProfile,
-        monitored,
-        tags,
-        state,
-        stateCode,
-        ID,
-        Status,
-        createdAt,
-        lastReportedAt,
-        version,
-        name,
-        description,
-        hostName,
-        isContainer,
-        kernel,
-        osVersion,
-    ):
-        self.id = id
-        self.kernelId = kernelId
-        self.instanceType = instanceType
-        self.privateDnsName = privateDnsName
-        self.privateIpAddress = privateIpAddress
-        self.group = group
-        self.subnetId = subnetId
-        self.keyName = keyName
-        self.region = region
-        self.launchTime = launchTime
-        self.imageId = imageId
-        self.architecture = architecture
-        self.publicDnsName = publicDnsName
-        self.publicIpAddress = publicIpAddress
-        self.vpcId = vpcId
-        self.awsProfile = awsProfile
-        self.monitored = monitored
-        self.tags = tags
-        self.state = state
-        self.stateCode = stateCode
-        self.ID = ID
-        self.Status = Status
-        self.createdAt = createdAt
-        self.lastReportedAt = lastReportedAt
-        self.version = version
-        self.name = name
-        self.description = description
-        self.hostName = hostName
-        self.isContainer = isContainer
-        self.kernel = kernel
-        self.osVersion = osVersion
-
-    def as_dict(self):
-        return {
-            "id": self.id,
-            "kernelId": self.kernelId,
-            "instanceType": self.instanceType,
-            "privateDnsName": self.privateDnsName,
-            "privateIpAddress": self.privateIpAddress,
-            "groups": self.group,
-            "subnetId": self.subnetId,
-            "keyName": self.keyName,
-            "region": self.region,
-            "launchTime": self.launchTime,
-            "imageId": self.imageId,
-            "architecture": self.architecture,
-            "publicDnsName": self.publicDnsName,
-            "publicIpAddress": self.publicIpAddress,
-            "vpcId": self.vpcId,
-            "awsProfile": self.awsProfile,
-            "keyName": self.keyName,
-            "monitored": self.monitored,
-            "tags": self.tags,
-            "state": self.state,
-            "stateCode": self.stateCode,
-            "ID": self.ID,
-            "Status": self.Status,
-            "createdAt": self.createdAt,
-            "lastReportedAt": self.lastReportedAt,
-            "version": self.version,
-            "name": self.name,
-            "description": self.description,
-            "hostName": self.hostName,
-            "isContainer": self.isContainer,
-            "kernel": self.kernel,
-            "osVersion": self.osVersion,
-        }
+    def __init__(self):
+        self.columns = {name: [] for name in EC2_COLUMNS}
+        self.count = 0
+
+        # Compile the schema into (column append, key) pairs once
+        self._instance_fields = [
+            (self.columns[name].extend, key) for name, key in EC2_INSTANCE_COLUMNS
+        ]
+        self._agent_fields = [
+            (self.columns[name].extend, key) for name, key in EC2_AGENT_COLUMNS
+        ]
+
+    def add_page(self, servers):
+        for extend, key in self._instance_fields:
+            extend([server.get(key) for server in servers])
+
+        first_agents = [
+            server["agents"][0] if server.get("agents") else NO_AGENT
+            for server in servers
+        ]
+        for extend, key in self._agent_fields:
+            extend([agent.get(key, "") for agent in first_agents])
+
+        self.count += len(servers)
+
+    def rows(self, start=0):
+        """
+        Yield each instance from position start on as a tuple, in EC2_COLUMNS order
+        """
+        return zip(*(self.columns[name][start:] for name in EC2_COLUMNS))
+
+    def records(self, start=0):
+        """
+        Yield each instance as a dict, for JSON lines output
+        """
+        names = [JSONL_NAMES.get(name, name) for name in EC2_COLUMNS]
+        for row in self.rows(start):
+            yield dict(zip(names, row))
+
+    def clear(self):
+        for column in self.columns.values():
+            column.clear()
+        self.count = 0
+
+    def to_dataframe(self):
+        return pandas.DataFrame(self.columns, columns=EC2_COLUMNS)
+
+
+def tag_rows(servers):
+    """
+    Yield one (instanceId, key, value, source) row per tag of each instance
+    """
+    for server in servers:
+        for tag in server.get("tags") or []:
+            yield (
+                server.get("id"),
+                tag.get("key", tag.get("Key")),
+                tag.get("value", tag.get("Value")),
+                tag.get("source", ""),
+            )
 
 
-class Group(object):
-    def __init__(self, ID, Name, Value, Instance):
-        self.ID = ID
-        self.Name = Name
+def group_rows(servers):
+    """
+    Yield one (instanceId, groupId, groupName) row per security group of each instance
+    """
+    for server in servers:
+        for group in server.get("groups") or []:
+            if isinstance(group, dict):
+                yield (
+                    server.get("id"),
+                    group.get("id", group.get("groupId")),
+                    group.get("name", group.get("groupName")),
+                )
+            else:
+                yield (server.get("id"), group, "")
+
+
+class EC2SideTables(object):
+    """
+    Streams the tag and security group side tables next to the main output
 
-    def as_dict(self):
-        return {"ID": self.ID, "Name": self.Name}
+    Rows are written as CSV, or JSON lines using the output's compression
+    and rotation, to <base>-tags and <base>-groups.
+    """
 
+    def __init__(self, base, output_opts):
+        output_format, compression, rotate_mb = output_opts
+        self.tables = {}
+        for name, columns in [("tags", TAG_COLUMNS), ("groups", GROUP_COLUMNS)]:
+            path = base + "-" + name
+            if output_format == "jsonl":
+                writer = tsoutput.JsonlSink(path, compression, rotate_mb)
+            else:
+                writer = open(path + ".csv", "w", newline="")
+                csv.writer(writer).writerow(columns)
+            self.tables[name] = (columns, writer)
+
+    def write(self, name, rows):
+        columns, writer = self.tables[name]
+        if isinstance(writer, tsoutput.JsonlSink):
+            writer.write_many(dict(zip(columns, row)) for row in rows)
+        else:
+            csv.writer(writer).writerows(rows)
 
-class awsProfile(object):
-    def __init__(
-        self,
-        ID,
-        OrgName,
-        Description,
-    ):
-        self.ID = ID
-        self.OrgName = OrgName
-        self.Description = Description
+    def close(self):
+        for _, writer in self.tables.values():
+            writer.close()
 
-    def as_dict(self):
-        return {"ID": self.ID, "OrgName": self.OrgName, "Description": self.Description}
 
+# Columns that change on every run without the instance changing
+SNAPSHOT_IGNORED_COLUMNS = ["lastReportedAt"]
 
-class tags(object):
-    def __init__(self, Source, Key, Value, Instance):
-        self.Source = Source
-        self.Key = Key
-        self.Value = Value
-        self.Instance = Instance
 
-    def as_dict(self):
-        return {
-            "Source": self.Source,
-            "Key": self.Key,
-            "Value": self.Value,
-            "Instance": self.Instance,
-        }
+def content_hash(record):
+    """
+    Return a short, stable hash of an instance record's content
+    """
+    content = {
+        name: value
+        for name, value in record.items()
+        if name not in SNAPSHOT_IGNORED_COLUMNS
+    }
+    encoded = json.dumps(content, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(encoded.encode("utf-8"), digest_size=8).hexdigest()
 
 
-class agents(object):
-    def __init__(
-        self,
-        ID,
-        Status,
-        createdAt,
-        lastReportedAt,
-        version,
-        name,
-        description,
-        hostName,
-        isContainer,
-        kernel,
-        osVersion,
-    ):
-        self.ID = ID
-        self.Status = Status
-        self.createdAt = createdAt
-        self.lastReportedAt = lastReportedAt
-        self.version = version
-        self.name = name
-        self.description = description
-        self.hostName = hostName
-        self.isContainer = isContainer
-        self.kernel = kernel
-        self.osVersion = osVersion
-
-    def as_dict(self):
-        return {
-            "ID": self.ID,
-            "Status": self.Status,
-            "createdAt": self.createdAt,
-            "lastReportedAt": self.lastReportedAt,
-            "version": self.version,
-            "name": self.name,
-            "description": self.description,
-            "hostName": self.hostName,
-            "isContainer": self.isContainer,
-            "kernel": self.kernel,
-            "osVersion": self.osVersion,
+class EC2Snapshot(object):
+    """
+    Compact per-instance snapshot, keyed by instance id, used to report only
+    what changed since the previous run
+
+    Each instance is stored as [content hash, state, agent id] so that
+    launches, terminations, state flips and agent loss can be told apart
+    without keeping the previous run's full rows.
+    """
+
+    def __init__(self, previous=None):
+        self.previous = previous or {}
+        self.current = {}
+        self.delta = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.isfile(path):
+            print("No previous snapshot at " + path + ", every instance is new.")
+            return cls()
+        with gzip.open(path, "rt") as f:
+            return cls(json.load(f)["instances"])
+
+    def save(self, path):
+        with gzip.open(path, "wt") as f:
+            json.dump({"taken": time.time(), "instances": self.current}, f)
+
+    def add_page(self, columns, start=0):
+        """
+        Hash the instances of an EC2Columns batch from position start on, and
+        compare them with the previous snapshot
+        """
+        for row in columns.rows(start):
+            record = dict(zip(EC2_COLUMNS, row))
+            entry = [content_hash(record), record["state"], record["ID"]]
+            previous = self.previous.get(record["id"])
+
+            with self._lock:
+                self.current[record["id"]] = entry
+                if previous is None:
+                    self.delta.append(self._change("added", record, None))
+                elif previous[0] != entry[0]:
+                    self.delta.append(self._change("changed", record, previous))
+
+    def finish(self):
+        """
+        Add every instance that was in the previous snapshot but not this one to the delta
+        """
+        for instance_id, previous in self.previous.items():
+            if instance_id not in self.current:
+                self.delta.append(self._change("removed", {"id": instance_id}, previous))
+        return self.delta
+
+    def _change(self, change, record, previous):
+        delta = {
+            "change": change,
+            "previousState": previous[1] if previous else "",
+            "previousAgentId": previous[2] if previous else "",
         }
+        delta.update(record)
+        return delta
 
 
 def get_args():
@@ -252,17 +337,126 @@ def get_args():
         default="DEFAULT",
     )
 
-    # Mutually exclusive alert status
+    # Mutually exclusive monitored status, monitored instances are the default
     status = parser.add_mutually_exclusive_group()
-    status.add_argument("--monitored", action="store_true")
-    status.add_argument("--unmonitored", action="store_false")
+    status.add_argument(
+        "--monitored",
+        dest="inventory",
+        action="store_const",
+        const="monitored",
+        help="Only instances with a Threat Stack agent (default).",
+    )
+    status.add_argument(
+        "--unmonitored",
+        dest="inventory",
+        action="store_const",
+        const="unmonitored",
+        help="Only instances without a Threat Stack agent.",
+    )
+    status.add_argument(
+        "--all",
+        dest="inventory",
+        action="store_const",
+        const="all",
+        help="Monitored and unmonitored instances, fetched concurrently into one file.",
+    )
+    parser.set_defaults(inventory="monitored")
+
+    parser.add_argument(
+        "--partition-by",
+        dest="partition_by",
+        choices=sorted(PARTITION_PARAMS),
+        help="Split the inventory into one cursor per region or AWS profile and fetch them concurrently.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--partitions-file",
+        dest="partitions_file",
+        help="Cached list of partition values (default EC2Partitions-<org>-<partition>.json).",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--partition-ttl-hours",
+        dest="partition_ttl",
+        type=float,
+        help="Re-plan with a single full pass once the cached partition list is this old.",
+        required=False,
+        default=24,
+    )
+
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="Maximum number of cursors fetched at once.",
+        required=False,
+        default=8,
+    )
+
+    parser.add_argument(
+        "--snapshot",
+        dest="snapshot",
+        help="Snapshot file of per-instance hashes. The previous snapshot is compared against to write a delta of added, removed and changed instances, then replaced.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--delta-only",
+        dest="delta_only",
+        action="store_true",
+        help="With --snapshot, only write the delta and skip the full inventory.",
+        required=False,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--side-tables",
+        dest="side_tables",
+        action="store_true",
+        help="Also write long-format tag (instanceId, key, value, source) and security group (instanceId, groupId, groupName) tables.",
+        required=False,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--ec2-index",
+        dest="ec2_index",
+        help="Also save the monitored instances as the shared EC2 agent index used by the other export scripts.",
+        required=False,
+        default=None,
+    )
+
+    tsoutput.add_output_args(parser)
+    tsoutput.add_archive_args(parser)
 
     cli_args = parser.parse_args()
 
     config_file = cli_args.config_file
     org_config = cli_args.org_config
-    monitored = cli_args.monitored
-    unmonitored = cli_args.unmonitored
+    inventory = cli_args.inventory
+    diff_opts = (cli_args.snapshot, cli_args.delta_only)
+    side_tables = cli_args.side_tables
+    ec2_index = cli_args.ec2_index
+
+    if cli_args.delta_only and not cli_args.snapshot:
+        print("--delta-only needs a --snapshot file, exiting.")
+        sys.exit(-1)
+    if ec2_index and inventory == "unmonitored":
+        print("--ec2-index needs the monitored instances, exiting.")
+        sys.exit(-1)
+    output_opts = (cli_args.output_format, cli_args.compression, cli_args.rotate_mb)
+    archive_opts = (
+        cli_args.archive_path,
+        cli_args.replay_path,
+        cli_args.cassette_path,
+        cli_args.cassette_mode,
+        cli_args.replay_latency,
+    )
 
     if not os.path.isfile(config_file):
         print("Unable to find config file: " + config_file + ", exiting.")
@@ -298,12 +492,34 @@ def get_args():
     tmp_org_name = re.sub("[\W_]+", "_", org_opts["TS_ORGANIZATION_NAME"])
     org_name = re.sub("[^A-Za-z0-9]+", "", tmp_org_name)
 
-    return user_id, api_key, org_id, org_name, monitored, unmonitored
+    partitions_file = cli_args.partitions_file
+    if cli_args.partition_by and not partitions_file:
+        partitions_file = (
+            "EC2Partitions" + "-" + org_name + "-" + cli_args.partition_by + ".json"
+        )
+    partition_opts = (
+        cli_args.partition_by,
+        partitions_file,
+        cli_args.partition_ttl,
+        cli_args.workers,
+    )
+
+    return (
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        inventory,
+        output_opts,
+        archive_opts,
+        diff_opts,
+        partition_opts,
+        side_tables,
+        ec2_index,
+    )
 
 
-def print_parsed_args(
-    user_id, api_key, org_id, org_name, state, monitored, unmonitored
-):
+def print_parsed_args(user_id, api_key, org_id, org_name, inventory):
     """
     This function is used to print the incoming args
 
@@ -312,129 +528,312 @@ def print_parsed_args(
     api_key (str) : Api Key used for Threatstack API
     org_id (str) : org id used for Threatstack API
     org_name (str) : org name used for Threatstack API
-    state (string): 'all', 'running', 'stopped', 'terminated'
-    monitored (bool) : Monitored is if the agent is installed and monitored in TS
-    unmonitored (bool) : Unmonitored if the agent is not installed and monitored in TS
+    inventory (str) : 'monitored', 'unmonitored' or 'all' instances
     """
 
     print("user_id: " + user_id)
     print("api_key: " + api_key)
     print("org_id: " + org_id)
     print("org_name: " + org_name)
-    print("monitored: " + str(monitored))
-    print("unmonitored: " + str(unmonitored))
+    print("inventory: " + inventory)
 
 
-def get_ec2_instances(userid, apikey, orgid, OUTPUT_FILE, monitored):
+def fetch_ec2_instances(tsclient, querystring, on_page):
     """
-    This function is used get all ec2 instances data based on monitored status
-    and state of the instances.
+    This function pages through one aws/ec2 cursor, handing each page of
+    raw instances to on_page
 
     Parameters:
-    userid (str) : User id used for Threatstack API
-    apikey (str) : Api Key used for Threatstack API
-    orgid (str) : org id used for Threatstack API
-    OUTPUT_FILE (str) : output file name to write ec2 instance data to.
-    monitored (bool) : Monitored is if the agent is installed and monitored in TS
+    tsclient (ApiClient) : client to make the requests with
+    querystring (str) : aws/ec2 endpoint and query string
+    on_page (function) : called with the list of instances in each page
     """
-    allorgec2 = []
-    tsclient = threatstack.ApiClient(
-        user_id=userid, org_id=orgid, api_key=apikey, retry=5
-    )
-    if monitored:
-        querystring = "aws/ec2?monitored=true&verbose=true"
-    else:
-        querystring = "aws/ec2?monitored=false&verbose=true"
     server_list = tsclient.get_list(querystring)
-    servercount = 0
     while server_list:
+        on_page(server_list.data)
 
-        for server in server_list.data:
-
-            if monitored:
-                allorgec2.append(
-                    Servers(
-                        server["id"],
-                        server["kernelId"],
-                        server["instanceType"],
-                        server["privateDnsName"],
-                        server["privateIpAddress"],
-                        server["groups"],
-                        server["subnetId"],
-                        server["keyName"],
-                        server["region"],
-                        server["launchTime"],
-                        server["imageId"],
-                        server["architecture"],
-                        server["publicDnsName"],
-                        server["publicIpAddress"],
-                        server["vpcId"],
-                        server["awsProfile"],
-                        server["monitored"],
-                        server["tags"],
-                        server["state"],
-                        server["stateCode"],
-                        server["agents"][0]["id"],
-                        server["agents"][0]["status"],
-                        server["agents"][0]["createdAt"],
-                        server["agents"][0]["lastReportedAt"],
-                        server["agents"][0]["version"],
-                        server["agents"][0]["name"],
-                        server["agents"][0]["description"],
-                        server["agents"][0]["hostname"],
-                        server["agents"][0]["isContainerAgent"],
-                        server["agents"][0]["kernel"],
-                        server["agents"][0]["osVersion"],
-                    )
-                )
-            else:
-                #  unmanaged instances don't have an agent so we expect no agent info
-                #  thus the 11 empty ""
-                allorgec2.append(
-                    Servers(
-                        server["id"],
-                        server["kernelId"],
-                        server["instanceType"],
-                        server["privateDnsName"],
-                        server["privateIpAddress"],
-                        server["groups"],
-                        server["subnetId"],
-                        server["keyName"],
-                        server["region"],
-                        server["launchTime"],
-                        server["imageId"],
-                        server["architecture"],
-                        server["publicDnsName"],
-                        server["publicIpAddress"],
-                        server["vpcId"],
-                        server["awsProfile"],
-                        server["monitored"],
-                        server["tags"],
-                        server["state"],
-                        server["stateCode"],
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                        "",
-                    )
-                )
-            servercount += 1
         if server_list.token:
             querystringtoken = querystring + "&token=" + server_list.token
             server_list = tsclient.get_list(querystringtoken)
-            time.sleep(0.09)
         else:
             server_list = None
 
-    allserversDF = pandas.DataFrame([x.__dict__ for x in allorgec2])
-    allserversDF.to_csv(OUTPUT_FILE, index=False)
+
+def partition_value(server, partition_by):
+    """
+    Return the value of the partition field for a raw instance
+    AWS profiles are objects, so they are identified by their id
+    """
+    value = server.get(partition_by)
+    if isinstance(value, dict):
+        value = value.get("id", value.get("ID"))
+    return value
+
+
+def sort_partitions(values):
+    """
+    Return partition values sorted, with the None bucket of instances that
+    have no value last
+    """
+    return sorted(values, key=lambda value: (value is None, str(value)))
+
+
+def load_partitions(partitions_file, partition_by, ttl_hours):
+    """
+    This function loads the cached list of partition values
+
+    Returns the sorted values, or None if there is no cache for partition_by
+    or it is older than ttl_hours
+    """
+    if not partitions_file or not os.path.isfile(partitions_file):
+        return None
+    with open(partitions_file) as f:
+        cached = json.load(f)
+    if cached.get("partitionBy") != partition_by:
+        return None
+    if time.time() - cached.get("updated", 0) > ttl_hours * 3600:
+        return None
+    return sort_partitions(cached["values"])
+
+
+def save_partitions(partitions_file, partition_by, values):
+    with open(partitions_file, "w") as f:
+        json.dump(
+            {
+                "partitionBy": partition_by,
+                "updated": time.time(),
+                "values": sort_partitions(values),
+            },
+            f,
+        )
+
+
+def get_ec2_instances(
+    userid,
+    apikey,
+    orgid,
+    OUTPUT_FILE,
+    inventory,
+    output_opts=("csv", "gzip", 0),
+    archive_opts=(None, None, None, "replay", None),
+    diff_opts=(None, False),
+    partition_opts=(None, None, 24, 8),
+    side_tables=False,
+    ec2_index=None,
+):
+    """
+    This function is used get all ec2 instances data based on monitored status
+    and state of the instances.
+
+    Parameters:
+    userid (str) : User id used for Threatstack API
+    apikey (str) : Api Key used for Threatstack API
+    orgid (str) : org id used for Threatstack API
+    OUTPUT_FILE (str) : output file name (without extension) to write ec2 instance data to.
+    inventory (str) : 'monitored', 'unmonitored' or 'all'. 'all' pages both
+        cursors concurrently on the same client and writes one combined output
+    output_opts (tuple) : output format, compression and rotation size in MB
+    archive_opts (tuple) : response archive to write to and to replay from, and cassette settings
+    diff_opts (tuple) : snapshot file to diff against, and whether to only write the delta
+    partition_opts (tuple) : field to partition by, partition cache file and its TTL in hours,
+        and the maximum number of concurrent cursors
+    side_tables (bool) : also write the long-format tag and security group tables
+    ec2_index (str) : file to save the monitored instances to as the shared EC2 agent index
+    """
+    output_format, compression, rotate_mb = output_opts
+    snapshot_file, delta_only = diff_opts
+    partition_by, partitions_file, partition_ttl, workers = partition_opts
+    sink = None
+    if output_format == "jsonl" and not delta_only:
+        sink = tsoutput.JsonlSink(OUTPUT_FILE, compression, rotate_mb)
+    sink_lock = threading.Lock()
+
+    tables = None
+    if side_tables:
+        tables = EC2SideTables(OUTPUT_FILE, output_opts)
+
+    snapshot = None
+    if snapshot_file:
+        snapshot = EC2Snapshot.load(snapshot_file)
+
+    # Plan the partitions from the cached list. Without a fresh one, this run is
+    # a single full pass per stream that records the values for the next run.
+    # Values that appear before the list expires are picked up by the next full pass
+    partitions = [None]
+    if partition_by:
+        cached = load_partitions(partitions_file, partition_by, partition_ttl)
+        if cached and None in cached:
+            # No filter can fetch the instances without a value
+            print(
+                "Some instances have no "
+                + partition_by
+                + ", planning from a full pass"
+            )
+        elif cached:
+            partitions = cached
+            print("Fetching " + str(len(partitions)) + " " + partition_by + " partitions")
+        else:
+            print("No fresh " + partition_by + " list, planning from a full pass")
+    seen_partitions = set()
+    index_entries = {}
+
+    # Every cursor shares one pooled client, and its rate limit replaces the
+    # old fixed sleep between pages
+    tsclient = threatstack.open_client(
+        userid,
+        orgid,
+        apikey,
+        5,
+        *archive_opts,
+        rate_limit=11,
+        pool_size=max(workers, 2)
+    )
+
+    if inventory == "all":
+        streams = ["monitored", "unmonitored"]
+    else:
+        streams = [inventory]
+
+    # Monitored instances come first, then each partition in sorted order
+    tasks = [(stream, partition) for stream in streams for partition in partitions]
+
+    def write_tables(task_tables):
+        for name, rows in task_tables.items():
+            tables.write(name, rows)
+            rows.clear()
+
+    def collect(index, stream, partition):
+        task_columns = EC2Columns()
+        task_tables = {"tags": [], "groups": []}
+        querystring = EC2_QUERIES[stream]
+        if partition is not None:
+            querystring = (
+                querystring
+                + "&"
+                + PARTITION_PARAMS[partition_by]
+                + "="
+                + urllib.parse.quote(str(partition))
+            )
+
+        def on_page(servers):
+            if partition is not None:
+                # If the API ignored the filter, every partition would be a full scan
+                for server in servers:
+                    if partition_value(server, partition_by) != partition:
+                        raise ValueError(
+                            "The API returned instances outside the "
+                            + PARTITION_PARAMS[partition_by]
+                            + "="
+                            + str(partition)
+                            + " filter, run without --partition-by"
+                        )
+            elif partition_by:
+                values = set(partition_value(server, partition_by) for server in servers)
+                with sink_lock:
+                    seen_partitions.update(values)
+
+            if ec2_index and stream == "monitored":
+                with sink_lock:
+                    ec2index.add_servers(index_entries, servers)
+
+            start = task_columns.count
+            task_columns.add_page(servers)
+            if tables is not None:
+                task_tables["tags"].extend(tag_rows(servers))
+                task_tables["groups"].extend(group_rows(servers))
+                if index == 0:
+                    with sink_lock:
+                        write_tables(task_tables)
+            if snapshot is not None:
+                snapshot.add_page(task_columns, start)
+
+            # The first task's JSON lines are streamed page by page, keeping
+            # nested fields intact; the rest are written in task order below
+            if sink is not None and index == 0:
+                with sink_lock:
+                    sink.write_many(task_columns.records())
+                task_columns.clear()
+            elif delta_only:
+                task_columns.clear()
+
+        fetch_ec2_instances(tsclient, querystring, on_page)
+        return task_columns, task_tables
+
+    results = []
+    with ThreadPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        futures = [
+            pool.submit(collect, index, stream, partition)
+            for index, (stream, partition) in enumerate(tasks)
+        ]
+        for future in futures:
+            task_columns, task_tables = future.result()
+            if tables is not None:
+                with sink_lock:
+                    write_tables(task_tables)
+            if sink is not None:
+                with sink_lock:
+                    sink.write_many(task_columns.records())
+                task_columns.clear()
+            results.append(task_columns)
+
+    print("API metrics: " + str(tsclient.metrics))
+
+    if tables is not None:
+        tables.close()
+
+    # Only a full pass sees every value, and restarts the TTL
+    if partition_by and partitions == [None]:
+        save_partitions(partitions_file, partition_by, seen_partitions)
+
+    if ec2_index:
+        ec2index.write_index(ec2_index, index_entries)
+        print(
+            "Saved EC2 index " + ec2_index + " (" + str(len(index_entries)) + " agents)"
+        )
+
+    if snapshot is not None:
+        write_delta(snapshot.finish(), OUTPUT_FILE + "-delta", output_opts)
+        snapshot.save(snapshot_file)
+
+    if sink is not None:
+        sink.close()
+        print("Wrote " + str(sink.records) + " instances to " + ", ".join(sink.files))
+        return
+
+    if delta_only:
+        return
+
+    allserversDF = pandas.concat(
+        [task_columns.to_dataframe() for task_columns in results], ignore_index=True
+    )
+    allserversDF.to_csv(OUTPUT_FILE + ".csv", index=False)
+
+
+def write_delta(delta, DELTA_FILE, output_opts):
+    """
+    This function writes the added, removed and changed instances since the last snapshot
+
+    Parameters:
+    delta (list) : change records from EC2Snapshot.finish
+    DELTA_FILE (str) : output file name (without extension) to write the delta to
+    output_opts (tuple) : output format, compression and rotation size in MB
+    """
+    output_format, compression, rotate_mb = output_opts
+    counts = {}
+    for change in delta:
+        counts[change["change"]] = counts.get(change["change"], 0) + 1
+    print("Changes since last snapshot: " + str(counts))
+
+    if output_format == "jsonl":
+        with tsoutput.JsonlSink(DELTA_FILE, compression, rotate_mb) as sink:
+            sink.write_many(
+                {JSONL_NAMES.get(name, name): value for name, value in change.items()}
+                for change in delta
+            )
+    else:
+        pandas.DataFrame(
+            delta, columns=["change", "previousState", "previousAgentId"] + EC2_COLUMNS
+        ).to_csv(DELTA_FILE + ".csv", index=False)
 
 
 def main():
@@ -445,20 +844,29 @@ def main():
         api_key,
         org_id,
         org_name,
-        monitored,
-        unmonitored,
+        inventory,
+        output_opts,
+        archive_opts,
+        diff_opts,
+        partition_opts,
+        side_tables,
+        ec2_index,
     ) = get_args()
 
-    if monitored:
-        OUTPUT_FILE = (
-            "EC2Instances" + "-" + org_name + "-monitored-" + timestamp + ".csv"
-        )
-        get_ec2_instances(user_id, api_key, org_id, OUTPUT_FILE, monitored)
-    else:
-        OUTPUT_FILE = (
-            "EC2Instances" + "-" + org_name + "-unmonitored-" + timestamp + ".csv"
-        )
-        get_ec2_instances(user_id, api_key, org_id, OUTPUT_FILE, unmonitored)
+    OUTPUT_FILE = "EC2Instances" + "-" + org_name + "-" + inventory + "-" + timestamp
+    get_ec2_instances(
+        user_id,
+        api_key,
+        org_id,
+        OUTPUT_FILE,
+        inventory,
+        output_opts,
+        archive_opts,
+        diff_opts,
+        partition_opts,
+        side_tables,
+        ec2_index,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,454 @@
+#   Copyright (c) 2022 F5, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Shared output helpers for the Threat Stack export scripts
+
+    JsonlSink streams records to newline delimited JSON, optionally compressed
+    with gzip or zstd, and rotates to a new file once the compressed output
+    reaches a size threshold. Nested fields (tags, groups, agents, ...) are
+    written as real JSON instead of Python repr strings.
+
+    SchemaWriter writes records with a fixed set of columns, mapped by name,
+    to CSV, JSON lines or Parquet, and counts any keys outside the schema.
+    CSV and JSON lines writers can be checkpointed and resumed after a crash.
+
+    The archive arguments let any exporter tee raw API responses to a
+    threatstack.ResponseArchive, or re-drive its output from one, and record
+    or replay a cassette for network-free, repeatable benchmark runs.
+"""
+
+import csv
+import gzip
+import json
+import os
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+FORMATS = ["csv", "jsonl"]
+SCHEMA_FORMATS = FORMATS + ["parquet"]
+COMPRESSIONS = ["none", "gzip", "zstd"]
+
+EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def add_output_args(parser, formats=FORMATS):
+    """
+    Add the shared output arguments to an argparse parser
+    Exporters that write through a SchemaWriter can pass SCHEMA_FORMATS
+    """
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=formats,
+        help="Output format: " + ", ".join(formats) + " (default csv).",
+        required=False,
+        default="csv",
+    )
+
+    parser.add_argument(
+        "--compress",
+        dest="compression",
+        choices=COMPRESSIONS,
+        help="Compression for JSON lines and Parquet output.",
+        required=False,
+        default="gzip",
+    )
+
+    parser.add_argument(
+        "--rotate-mb",
+        dest="rotate_mb",
+        type=int,
+        help="Start a new JSON lines file once the current one reaches this many MB (0 disables rotation).",
+        required=False,
+        default=0,
+    )
+
+
+def add_archive_args(parser):
+    """
+    Add the raw response archive arguments to an argparse parser
+    """
+    parser.add_argument(
+        "--archive",
+        dest="archive_path",
+        help="Append every raw API response to this archive file (with a .idx index next to it).",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--replay-archive",
+        dest="replay_path",
+        help="Re-run the export from a response archive instead of calling the API.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cassette",
+        dest="cassette_path",
+        help="Record every API exchange to this cassette, or replay them from it (see --cassette-mode).",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cassette-mode",
+        dest="cassette_mode",
+        choices=["record", "replay"],
+        required=False,
+        default="replay",
+    )
+
+    parser.add_argument(
+        "--replay-latency",
+        dest="replay_latency",
+        type=replay_latency,
+        help="Seconds to wait per replayed request, or 'recorded' to wait as long as the original request took.",
+        required=False,
+        default=None,
+    )
+
+
+def replay_latency(value):
+    """
+    argparse type for --replay-latency
+    """
+    if value == "recorded":
+        return value
+    return float(value)
+
+
+class JsonlSink:
+    """
+    This class streams records to one or more JSON lines files
+
+    Files are named <base>-00000.jsonl[.gz|.zst], <base>-00001.jsonl[...], ...
+    when rotation is enabled, or <base>.jsonl[...] when it is not.
+    It can be used as a context manager so the last file is always closed.
+
+    checkpoint() ends the current gzip member or zstd frame, so that the
+    file is readable up to that point, and returns the state resume() needs
+    to truncate back to it and carry on appending.
+    """
+
+    def __init__(self, base, compression="gzip", rotate_mb=0):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression: " + str(compression))
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+
+        setattr(self, "base", base)
+        setattr(self, "compression", compression)
+        setattr(self, "rotate_bytes", rotate_mb * 1024 * 1024)
+        setattr(self, "files", [])
+        setattr(self, "records", 0)
+
+        self._raw = None
+        self._stream = None
+
+    def _next_path(self):
+        if self.rotate_bytes:
+            suffix = "-{:05d}.jsonl".format(len(self.files))
+        else:
+            suffix = ".jsonl"
+        return self.base + suffix + EXTENSIONS[self.compression]
+
+    def _open(self):
+        path = self._next_path()
+        self._raw = open(path, "wb")
+        self._wrap()
+        self.files.append(path)
+
+    def _wrap(self):
+        # Start a new gzip member or zstd frame on the open file
+        if self.compression == "gzip":
+            self._stream = gzip.GzipFile(fileobj=self._raw, mode="wb")
+        elif self.compression == "zstd":
+            self._stream = zstandard.ZstdCompressor().stream_writer(
+                self._raw, closefd=False
+            )
+        else:
+            self._stream = self._raw
+
+    def _close_current(self):
+        if self._stream is not None and self._stream is not self._raw:
+            self._stream.close()
+        if self._raw is not None and not self._raw.closed:
+            self._raw.close()
+        self._stream = None
+        self._raw = None
+
+    def write(self, record):
+        """
+        Write a single record (any JSON serializable object) as one line
+        """
+        if self._raw is None:
+            self._open()
+        elif self._stream is None:
+            self._wrap()
+
+        line = json.dumps(record, separators=(",", ":"), default=str)
+        self._stream.write(line.encode("utf-8") + b"\n")
+        self.records += 1
+
+        # The raw file position is the compressed size flushed so far
+        if self.rotate_bytes and self._raw.tell() >= self.rotate_bytes:
+            self._close_current()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def checkpoint(self):
+        """
+        Make everything written so far durable and return the state to resume from
+        """
+        offset = None
+        if self._raw is not None:
+            if self._stream is not None and self._stream is not self._raw:
+                self._stream.close()
+                self._stream = None
+            self._raw.flush()
+            os.fsync(self._raw.fileno())
+            offset = self._raw.tell()
+        return {"files": list(self.files), "offset": offset, "records": self.records}
+
+    def resume(self, state):
+        """
+        Carry on from a checkpoint, dropping anything written after it
+        """
+        self.files[:] = state["files"]
+        self.records = state["records"]
+        if state["offset"] is not None:
+            self._raw = open(self.files[-1], "r+b")
+            self._raw.truncate(state["offset"])
+            self._raw.seek(state["offset"])
+
+    def close(self):
+        self._close_current()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def save_checkpoint(path, state):
+    """
+    Write a checkpoint file, replacing the previous one in a single step
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, default=str)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path):
+    """
+    Return the state saved in a checkpoint file, or None if there isn't one
+    """
+    if not path or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class SchemaWriter:
+    """
+    This class writes records with a fixed schema to CSV, JSON lines or Parquet
+
+    columns is a list of (output column, record key) pairs. Each record is
+    mapped into the columns by key, so the key order of the record doesn't
+    matter and missing keys are written as empty values. Keys that are not in
+    the schema are counted in unexpected instead of being written.
+
+    Parquet output needs the optional pyarrow package. Every column is stored
+    as a string, with lists and objects encoded as JSON, and rows are written
+    in row groups of batch_rows.
+
+    CSV and JSON lines output can be checkpointed; passing the returned state
+    back as resume reopens the output at that point instead of starting over.
+
+    write_frame writes a pandas DataFrame the same way, with CSV rows
+    written by pandas directly.
+    """
+
+    def __init__(
+        self,
+        base,
+        columns,
+        output_format="csv",
+        compression="gzip",
+        rotate_mb=0,
+        batch_rows=65536,
+        resume=None,
+    ):
+        if output_format not in SCHEMA_FORMATS:
+            raise ValueError("Unknown output format: " + str(output_format))
+        if output_format == "parquet" and pyarrow is None:
+            raise ValueError("Parquet output requires the pyarrow package")
+        if output_format == "parquet" and resume is not None:
+            raise ValueError("Parquet output can't be resumed")
+
+        setattr(self, "names", [name for name, _ in columns])
+        setattr(self, "keys", [key for _, key in columns])
+        setattr(self, "output_format", output_format)
+        setattr(self, "batch_rows", batch_rows)
+        setattr(self, "records", 0)
+        setattr(self, "unexpected", {})
+        if resume is not None:
+            self.records = resume["records"]
+            self.unexpected = dict(resume["unexpected"])
+
+        self._known = frozenset(self.keys)
+        self._sink = None
+        self._file = None
+        self._csv = None
+        self._batch = None
+        self._parquet = None
+
+        if output_format == "jsonl":
+            self._sink = JsonlSink(base, compression, rotate_mb)
+            if resume is not None:
+                self._sink.resume(resume["sink"])
+            setattr(self, "files", self._sink.files)
+        elif output_format == "csv":
+            if resume is not None:
+                os.truncate(base + ".csv", resume["offset"])
+                self._file = open(base + ".csv", "a", newline="")
+                self._csv = csv.writer(self._file, lineterminator="\n")
+            else:
+                self._file = open(base + ".csv", "w", newline="")
+                self._csv = csv.writer(self._file, lineterminator="\n")
+                self._csv.writerow(self.names)
+            setattr(self, "files", [base + ".csv"])
+        else:
+            codec = {"none": "none", "gzip": "gzip", "zstd": "zstd"}[compression]
+            schema = pyarrow.schema([(name, pyarrow.string()) for name in self.names])
+            self._parquet = pyarrow.parquet.ParquetWriter(
+                base + ".parquet", schema, compression=codec
+            )
+            self._batch = [[] for _ in self.names]
+            setattr(self, "files", [base + ".parquet"])
+
+    def _row(self, record):
+        extra = record.keys() - self._known
+        if extra:
+            for key in extra:
+                self.unexpected[key] = self.unexpected.get(key, 0) + 1
+        get = record.get
+        return [get(key, "") for key in self.keys]
+
+    def write_many(self, records):
+        self._write_rows([self._row(record) for record in records])
+
+    def write_frame(self, frame):
+        """
+        Write a pandas DataFrame, mapping its columns by name like write_many
+        Columns outside the schema are counted by their non-empty values
+        """
+        for key in frame.columns:
+            if key not in self._known:
+                count = int(frame[key].notna().sum())
+                if count:
+                    self.unexpected[key] = self.unexpected.get(key, 0) + count
+
+        frame = frame.reindex(columns=self.keys)
+        if self._csv is not None:
+            frame.to_csv(self._file, header=False, index=False)
+            self.records += len(frame)
+        else:
+            frame = frame.astype(object).where(frame.notna(), "")
+            self._write_rows(list(frame.itertuples(index=False, name=None)))
+
+    def _write_rows(self, rows):
+        self.records += len(rows)
+
+        if self._csv is not None:
+            self._csv.writerows(rows)
+        elif self._sink is not None:
+            names = self.names
+            self._sink.write_many(dict(zip(names, row)) for row in rows)
+        else:
+            for column, values in zip(self._batch, zip(*rows)):
+                column.extend(parquet_value(value) for value in values)
+            if len(self._batch[0]) >= self.batch_rows:
+                self._flush()
+
+    def write(self, record):
+        self.write_many([record])
+
+    def checkpoint(self):
+        """
+        Make everything written so far durable and return the state to resume from
+        """
+        state = {"records": self.records, "unexpected": dict(self.unexpected)}
+        if self._sink is not None:
+            state["sink"] = self._sink.checkpoint()
+        elif self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            state["offset"] = self._file.tell()
+        else:
+            raise ValueError("Parquet output can't be checkpointed")
+        return state
+
+    def _flush(self):
+        if self._batch and self._batch[0]:
+            self._parquet.write_table(
+                pyarrow.Table.from_arrays(
+                    [pyarrow.array(column, pyarrow.string()) for column in self._batch],
+                    names=self.names,
+                )
+            )
+            self._batch = [[] for _ in self.names]
+
+    def close(self):
+        if self._parquet is not None:
+            self._flush()
+            self._parquet.close()
+        if self._file is not None:
+            self._file.close()
+        if self._sink is not None:
+            self._sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def parquet_value(value):
+    """
+    Convert a value to the string stored in a Parquet column
+    """
+    if value is None or isinstance(value, str):
+        return value
+    return json.dumps(value, separators=(",", ":"), default=str)
@@ -29,7 +29,9 @@ import sys
 
 import pandas
 
+import rulestore
 import threatstack
+import tsoutput
 
 class RuleDetails(object):
     def __init__(
@@ -95,10 +97,49 @@ def get_args():
         default="DEFAULT",
     )
 
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        help="Maximum number of rulesets whose rules are fetched at once (default 8).",
+        required=False,
+        default=8,
+    )
+
+    parser.add_argument(
+        "--rules-snapshot",
+        dest="rules_snapshot",
+        help="Local snapshot of the rulesets and rules. Only rulesets that changed since the last run are fetched again, then the snapshot is updated.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--snapshot-max-age-hours",
+        dest="snapshot_max_age",
+        type=float,
+        help="Fetch the rules of a ruleset again once its snapshot is this old, even if it didn't change (default 24).",
+        required=False,
+        default=24,
+    )
+
+    tsoutput.add_output_args(parser)
+    tsoutput.add_archive_args(parser)
+
     cli_args = parser.parse_args()
 
     config_file = cli_args.config_file
     org_config = cli_args.org_config
+    workers = cli_args.workers
+    snapshot_opts = (cli_args.rules_snapshot, cli_args.snapshot_max_age)
+    output_opts = (cli_args.output_format, cli_args.compression, cli_args.rotate_mb)
+    archive_opts = (
+        cli_args.archive_path,
+        cli_args.replay_path,
+        cli_args.cassette_path,
+        cli_args.cassette_mode,
+        cli_args.replay_latency,
+    )
 
     if not os.path.isfile(config_file):
         print("Unable to find config file: " + config_file + ", exiting.")
@@ -134,7 +175,16 @@ def get_args():
     tmp_org_name = re.sub("[\W_]+", "_", org_opts["TS_ORGANIZATION_NAME"])
     org_name = re.sub("[^A-Za-z0-9]+", "", tmp_org_name)
 
-    return user_id, api_key, org_id, org_name
+    return (
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        output_opts,
+        archive_opts,
+        workers,
+        snapshot_opts,
+    )
 
 
 def print_parsed_args(user_id, api_key, org_id, org_name):
@@ -155,87 +205,129 @@ def print_parsed_args(user_id, api_key, org_id, org_name):
     print("org_name: " + org_name)
 
 
-def get_suppressions(userid, apikey, orgid, org_name):
+def rule_rows(ruleset, rules):
+    """
+    This function returns a RuleDetails row per rule and suppression of a ruleset
+    Rules without suppressions get a single row with empty Suppressions.
+    """
+    ruleset_rules = []
+    for rule in rules:
+        for suppression in rule["suppressions"] or [""]:
+            ruleset_rules.append(
+                RuleDetails(
+                    ruleset["id"],
+                    ruleset["name"],
+                    rule["id"],
+                    rule["name"],
+                    rule["title"],
+                    str(rule["alertDescription"]).replace("\n", " "),
+                    rule["enabled"],
+                    rule["severityOfAlerts"],
+                    suppression,
+                )
+            )
+    return ruleset_rules
+
+
+def get_suppressions(
+    userid,
+    apikey,
+    orgid,
+    org_name,
+    output_opts=("csv", "gzip", 0),
+    archive_opts=(None, None, None, "replay", None),
+    workers=8,
+    snapshot_opts=(None, 24),
+):
     """
     This function is used to get all the suppressions for a specfic org
     This is then writen out to a csv file
+    The rules of up to workers rulesets are fetched at once, and written in
+    the order the rulesets are listed, so the output is the same on every run
+    With a rules snapshot, only the rulesets that changed are fetched again
 
     Parameters:
     user_id (str) : User id used for Threat Stack API
     api_key (str) : Api Key used for Threat Stack API
     org_id (str) : org id used for Threat Stack API
     org_name (str) : org name used for Threat Stack API
-
+    output_opts (tuple) : output format, compression and rotation size in MB
+    archive_opts (tuple) : response archive to write to and to replay from, and cassette settings
+    workers (int) : maximum number of rulesets fetched at once
+    snapshot_opts (tuple) : rules snapshot file and the maximum age of a ruleset in it, in hours
 
     """
+    output_format, compression, rotate_mb = output_opts
+    rules_snapshot, snapshot_max_age = snapshot_opts
     all_org_rules = []
 
-    uaclient = threatstack.ApiClient(
-        user_id=userid, org_id=orgid, api_key=apikey, retry=5
+    # Every worker shares one pooled, rate limited client
+    uaclient = threatstack.open_client(
+        userid,
+        orgid,
+        apikey,
+        5,
+        *archive_opts,
+        rate_limit=11,
+        pool_size=max(workers, 2)
     )
 
-    ruleset_list = uaclient.get_list("rulesets")
-
-    while ruleset_list:
-
-        for rulesets in ruleset_list.data:
-            # Get Details for each ruleset
-            print("Getting ruleset: " + rulesets["name"])
-
-            querystring = "rulesets/" + rulesets["id"] + "/rules"
-
-            rules = uaclient.get_list(querystring)
-            for rule in rules.data:
-                if not rule["suppressions"]:
-                    all_org_rules.append(
-                        RuleDetails(
-                            rulesets["id"],
-                            rulesets["name"],
-                            rule["id"],
-                            rule["name"],
-                            rule["title"],
-                            str(rule["alertDescription"]).replace("\n", " "),
-                            rule["enabled"],
-                            rule["severityOfAlerts"],
-                            "",
-                        )
-                    )
-                else:
-                    for suppression in rule["suppressions"]:
-                        all_org_rules.append(
-                            RuleDetails(
-                                rulesets["id"],
-                                rulesets["name"],
-                                rule["id"],
-                                rule["name"],
-                                rule["title"],
-                                str(rule["alertDescription"]).replace("\n", " "),
-                                rule["enabled"],
-                                rule["severityOfAlerts"],
-                                suppression,
-                            )
-                        )
-            print("Finished getting all rules in: " + rulesets["name"])
-            ruleset_list = None
+    rule_store = rulestore.RuleStore(rules_snapshot)
+    refetched = rule_store.refresh(uaclient, snapshot_max_age, workers)
+    print(
+        "Fetched the rules of "
+        + str(refetched)
+        + " of "
+        + str(len(rule_store.rulesets))
+        + " rulesets"
+    )
+    if rules_snapshot:
+        rule_store.save()
 
-    allrulesDF = pandas.DataFrame([x.__dict__ for x in all_org_rules])
+    for entry in rule_store.rulesets:
+        all_org_rules.extend(rule_rows(entry["ruleset"], entry["rules"]))
 
-    rulefile = (
-        org_name + "-All-Rules-" + f"{datetime.datetime.now():%Y-%m-%d-%H-%M}" + ".csv"
-    )
-    allrulesDF.to_csv(rulefile, index=False)
+    print("API metrics: " + str(uaclient.metrics))
+
+    rulefile = org_name + "-All-Rules-" + f"{datetime.datetime.now():%Y-%m-%d-%H-%M}"
+
+    if output_format == "jsonl":
+        with tsoutput.JsonlSink(rulefile, compression, rotate_mb) as sink:
+            sink.write_many(x.as_dict() for x in all_org_rules)
+        return
+
+    allrulesDF = pandas.DataFrame([x.__dict__ for x in all_org_rules])
+    allrulesDF.to_csv(rulefile + ".csv", index=False)
 
 
 def main():
 
     # Call GetArgs and get set the values for next function calls
-    user_id, api_key, org_id, org_name = get_args()
+    (
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        output_opts,
+        archive_opts,
+        workers,
+        snapshot_opts,
+    ) = get_args()
 
     # Print out the ags
     print_parsed_args(user_id, api_key, org_id, org_name)
 
     # Now go call getsuppressions to do it's api calls
-    get_suppressions(user_id, api_key, org_id, org_name)
+    get_suppressions(
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        output_opts,
+        archive_opts,
+        workers,
+        snapshot_opts,
+    )
 
 
 if __name__ == "__main__":
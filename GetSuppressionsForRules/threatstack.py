@@ -3,72 +3,293 @@
 #   Licensed under the Apache License, Version 2.0 (the "License");
 #   you may not use this file except in compliance with the License.
 #   You may obtain a copy of the License at
-# 
+#
 #      http://www.apache.org/licenses/LICENSE-2.0
-# 
+#
 #   Unless required by applicable law or agreed to in writing, software
 #   distributed under the License is distributed on an "AS IS" BASIS,
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+
 from mohawk import Sender
 import requests
-import time
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def stdlib_loads(content):
+    """
+    Decode a JSON body with the standard library
+    json.loads takes bytes directly, but not a memoryview
+    """
+    if isinstance(content, memoryview):
+        content = content.tobytes()
+    return json.loads(content)
+
+
+def default_decoder():
+    """
+    Return the fastest JSON decoder available, orjson if it's installed and the standard library otherwise
+    Both decode straight from the response bytes, without building an intermediate str
+    """
+    if orjson is not None:
+        return orjson.loads
+    return stdlib_loads
+
+
+# Clients can be shared between threads, so metric updates take a lock
+_metrics_lock = threading.Lock()
+
+
+def new_metrics():
+    return {
+        "requests": 0,
+        "bytes": 0,
+        "decodes": 0,
+        "decode_seconds": 0.0,
+        "throttle_seconds": 0.0,
+    }
+
+
+def add_metrics(metrics, **values):
+    with _metrics_lock:
+        for key, value in values.items():
+            metrics[key] += value
+
+
+def decode_body(decoder, content, metrics):
+    """
+    Decode a response body, adding the time it took to the client's metrics
+    """
+    started = time.perf_counter()
+    data = decoder(content)
+    add_metrics(metrics, decodes=1, decode_seconds=time.perf_counter() - started)
+    return data
+
+
+def backoff_delay(attempts):
+    """
+    Return the seconds to wait before retrying a request that failed attempts times:
+    1, 2, 4, 8... capped at 30
+    """
+    return min(2 ** (attempts - 1), 30)
+
+
+class RateLimiter:
+    """
+    This class spaces out requests so that, across every thread sharing it,
+    no more than rate requests are started per second
+    """
+
+    def __init__(self, rate):
+        setattr(self, "interval", 1.0 / rate)
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """
+        Block until the caller may start a request, returning how long it waited
+        """
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
 
 class ApiClient:
-    '''
+    """
     This class defines the Threat Stack API client object
     Its goal is to allow the user to easily make calls against the API
-    '''
-    def __init__(self, api_key, org_id, user_id, base_url = 'https://api.threatstack.com/v2/', timeout = 30, retry = 5):
-        setattr(self, 'api_key', api_key)
-        setattr(self, 'org_id', org_id)
-        setattr(self, 'user_id', user_id)
-        setattr(self, 'timeout', timeout)
-        setattr(self, 'retry', retry)
-        setattr(self, 'credentials', {
-            'id': user_id,
-            'key': api_key,
-            'algorithm': 'sha256'
-        })
-        setattr(self, 'base_url', base_url)
-
-    def get_list(self, endpoint, query_string = '', token = ''):
-        '''
+    A client can be shared between threads: requests go through one pooled session,
+    and an optional rate limit (requests per second) applies to all of them together
+    """
+
+    SUCCESS_CODE = [200, 201, 202, 204]
+
+    def __init__(
+        self,
+        api_key,
+        org_id,
+        user_id,
+        base_url="https://api.threatstack.com/v2/",
+        timeout=30,
+        retry=5,
+        archive=None,
+        cassette=None,
+        cassette_mode="replay",
+        replay_latency=None,
+        decoder=None,
+        pool_size=10,
+        rate_limit=None,
+    ):
+        setattr(self, "api_key", api_key)
+        setattr(self, "org_id", org_id)
+        setattr(self, "user_id", user_id)
+        setattr(self, "timeout", timeout)
+        setattr(self, "retry", retry)
+        setattr(
+            self, "credentials", {"id": user_id, "key": api_key, "algorithm": "sha256"}
+        )
+        setattr(self, "base_url", base_url)
+        setattr(self, "archive", archive)
+        setattr(self, "cassette", cassette)
+        setattr(self, "cassette_mode", cassette_mode)
+        setattr(self, "replay_latency", replay_latency)
+        setattr(self, "decoder", decoder or default_decoder())
+        setattr(self, "metrics", new_metrics())
+        setattr(self, "pool_size", pool_size)
+        setattr(self, "rate_limit", rate_limit)
+
+        # Keep connections alive between requests, with up to pool_size of them open at once
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+
+        self._limiter = None
+        if rate_limit:
+            self._limiter = RateLimiter(rate_limit)
+
+        # A cassette records every exchange in record mode, and serves them back in replay mode
+        self._recorder = None
+        self._player = None
+        if cassette and cassette_mode == "record":
+            # Re-recording replaces the cassette, replay would serve the old exchanges first
+            self._recorder = ResponseArchive(cassette, truncate=True)
+        elif cassette and cassette_mode == "replay":
+            self._player = ArchiveReader(cassette, base_url, decoder)
+        elif cassette:
+            raise ValueError("Unknown cassette mode: " + str(cassette_mode))
+
+    def _send(self, method, full_url, data=None):
+        """
+        This method signs and sends a single request to the API
+        If an archive is configured, successful response bodies are copied to it as received
+        If a cassette is being replayed, the recorded response is returned instead
+        """
+        if self._player is not None:
+            resp = self._player.replay(method, full_url, data, self.replay_latency)
+            add_metrics(self.metrics, requests=1, bytes=len(resp.content))
+            return resp
+
+        if self._limiter is not None:
+            add_metrics(self.metrics, throttle_seconds=self._limiter.wait())
+
+        if data:
+            sender = Sender(
+                self.credentials,
+                full_url,
+                method,
+                always_hash_content=False,
+                ext=self.org_id,
+                content=data,
+                content_type="application/json",
+            )
+            headers = {
+                "Authorization": sender.request_header,
+                "Content-Type": "application/json",
+            }
+        else:
+            sender = Sender(
+                self.credentials,
+                full_url,
+                method,
+                always_hash_content=False,
+                ext=self.org_id,
+            )
+            headers = {"Authorization": sender.request_header}
+
+        started = time.monotonic()
+        resp = self._session.request(
+            method, full_url, headers=headers, timeout=self.timeout, data=data
+        )
+        elapsed = time.monotonic() - started
+        add_metrics(self.metrics, requests=1, bytes=len(resp.content))
+
+        # Cassettes keep every exchange, including errors, so retries replay the same way
+        if self._recorder is not None:
+            self._recorder.append(
+                method,
+                full_url,
+                resp.status_code,
+                resp.content,
+                signature=request_signature(method, full_url, data),
+                elapsed=elapsed,
+            )
+
+        if self.archive is not None and resp.status_code in ApiClient.SUCCESS_CODE:
+            self.archive.append(method, full_url, resp.status_code, resp.content)
+
+        return resp
+
+    def get_list(self, endpoint, query_string="", token=""):
+        """
         This method queries a Threat Stack endpoint which returns a list of objects
         It takes a required parameter of endpoint, as well as optional parameters of
         query_string and token
         It returns an object with properties status_code, data, and token
-        '''
-        #Attempts tracks the number of times a request was attempted
+        """
+        # Attempts tracks the number of times a request was attempted
         attempts = 1
         while True:
-            #Build the full URL string
-            full_url = self.base_url + endpoint + query_string
-
-            #Append the token if it's defined
-            if token:
-                if query_string:
-                    full_url = full_url + '&token=' + token
-                else:
-                    full_url = full_url + '?token=' + token
-
-            #Get the raw output from the API
-            sender = Sender(self.credentials, full_url, 'GET', always_hash_content = False, ext = self.org_id)
-            resp = requests.get(full_url, headers = {'Authorization': sender.request_header}, timeout = self.timeout)
+            # Build the full URL string, appending the token if it's defined
+            full_url = build_list_url(self.base_url, endpoint, query_string, token)
 
-            #If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try the request again
-            if resp.status_code != 200:
+            # Get the raw output from the API, a dropped connection or timeout counts as a failed attempt
+            try:
+                resp = self._send("GET", full_url)
+            except requests.exceptions.RequestException as e:
+                if attempts == self.retry:
+                    print("Error: Max retries exceeded!")
+                    raise
+                print(
+                    "Warning: Sleeping, request to Threat Stack API failed: {} (tried {} {})".format(
+                        e, attempts, "time" if attempts == 1 else "times"
+                    )
+                )
+                time.sleep(backoff_delay(attempts))
+                attempts += 1
+                continue
+
+            # If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try the request again
+            if resp.status_code not in ApiClient.SUCCESS_CODE:
                 if attempts == 1:
                     if resp.status_code != 429:
-                        print("Warning: Sleeping, Threat Stack API returned a {}! (tried {} time)".format(resp.status_code, attempts))
+                        print(
+                            "Warning: Sleeping, Threat Stack API returned a {}! (tried {} time)".format(
+                                resp.status_code, attempts
+                            )
+                        )
+                        if resp.status_code >= 500 and attempts < self.retry:
+                            time.sleep(backoff_delay(attempts))
                     else:
                         print("Back off", attempts)
                         time.sleep(2)
                 else:
                     if resp.status_code != 429:
-                        print("Warning: Sleeping, Threat Stack API returned a {}! (tried {} times)".format(resp.status_code, attempts))
+                        print(
+                            "Warning: Sleeping, Threat Stack API returned a {}! (tried {} times)".format(
+                                resp.status_code, attempts
+                            )
+                        )
+                        if resp.status_code >= 500 and attempts < self.retry:
+                            time.sleep(backoff_delay(attempts))
                     else:
                         print("Back off", attempts)
                         time.sleep(2)
@@ -78,36 +299,55 @@ class ApiClient:
                     handle_api_error(resp.status_code, resp.text)
                 else:
                     attempts += 1
-            #Else, format the response object and return it
+            # Else, format the response object and return it
             else:
-                resp_object = ListResponse(resp.status_code, resp.json())
+                resp_object = ListResponse(
+                    resp.status_code, resp.content, self.decoder, self.metrics
+                )
                 return resp_object
 
-    def get_one(self, endpoint, query_string = ''):
-        '''
+    def get_one(self, endpoint, query_string=""):
+        """
         This method queries a Threat Stack endpoint which returns a single object
         It takes a required parameter of endpoint, as well as an optional parameter of
         query_string
         It returns an object with properties status_code and data
-        '''
-        
-        #Attempts tracks the number of times a request was attempted
+        """
+
+        # Attempts tracks the number of times a request was attempted
         attempts = 1
         while True:
-            #Build the full URL string
+            # Build the full URL string
             full_url = self.base_url + endpoint + query_string
 
-            #Get the raw output from the API
-            sender = Sender(self.credentials, full_url, 'GET', always_hash_content = False, ext = self.org_id)
-            resp = requests.get(full_url, headers = {'Authorization': sender.request_header}, timeout = self.timeout)
-
-
-            #If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
-
-            if resp.status_code != 200:
+            # Get the raw output from the API, a dropped connection or timeout counts as a failed attempt
+            try:
+                resp = self._send("GET", full_url)
+            except requests.exceptions.RequestException as e:
+                if attempts == self.retry:
+                    print("Error: Max retries exceeded!")
+                    raise
+                print(
+                    "Warning: Sleeping, request to Threat Stack API failed: {} (tried {} {})".format(
+                        e, attempts, "time" if attempts == 1 else "times"
+                    )
+                )
+                time.sleep(backoff_delay(attempts))
+                attempts += 1
+                continue
+
+            # If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
+
+            if resp.status_code not in ApiClient.SUCCESS_CODE:
                 if attempts == 1:
-                    if resp.status_code != 429 and resp.status_code !=404:
-                        print("Warning: Sleeping, Threat Stack API returned a {}! (tried {} time)".format(resp.status_code, attempts))
+                    if resp.status_code != 429 and resp.status_code != 404:
+                        print(
+                            "Warning: Sleeping, Threat Stack API returned a {}! (tried {} time)".format(
+                                resp.status_code, attempts
+                            )
+                        )
+                        if resp.status_code >= 500 and attempts < self.retry:
+                            time.sleep(backoff_delay(attempts))
                     elif resp.status_code == 404:
                         attempts = self.retry
                         handle_api_error(resp.status_code, resp.text)
@@ -116,8 +356,14 @@ class ApiClient:
                         time.sleep(30)
                         print("paused for 30")
                 else:
-                    if resp.status_code != 429 and resp.status_code !=404:
-                        print("Warning: Sleeping, Threat Stack API returned a {}! (tried {} time)".format(resp.status_code, attempts))
+                    if resp.status_code != 429 and resp.status_code != 404:
+                        print(
+                            "Warning: Sleeping, Threat Stack API returned a {}! (tried {} time)".format(
+                                resp.status_code, attempts
+                            )
+                        )
+                        if resp.status_code >= 500 and attempts < self.retry:
+                            time.sleep(backoff_delay(attempts))
                     elif resp.status_code == 404:
                         attempts = self.retry
                         handle_api_error(resp.status_code, resp.text)
@@ -132,292 +378,605 @@ class ApiClient:
                 else:
                     attempts += 1
 
-            #Else, format the response object and return it
+            # Else, format the response object and return it
             else:
-                resp_object = OneResponse(resp.status_code, resp.json())
+                resp_object = OneResponse(
+                    resp.status_code, resp.content, self.decoder, self.metrics
+                )
                 return resp_object
 
     def post(self, endpoint, data):
-        '''
+        """
         This method allows the user to make a POST request to one of Threat Stack's Write API endpoints
         It takes required parameters of endpoint and data
-        '''
-        #Attempts tracks the number of times a request was attempted
+        """
+        # Attempts tracks the number of times a request was attempted
         attempts = 1
         while True:
-            #Build the full URL string
+            # Build the full URL string
             full_url = self.base_url + endpoint
 
-            #Post the data to the API
-            sender = Sender(self.credentials, full_url, 'POST', always_hash_content = False, ext = self.org_id, content = data, content_type = 'application/json')
-            resp = requests.post(full_url, headers = {'Authorization': sender.request_header, 'Content-Type': 'application/json'}, timeout = self.timeout, data = data)
+            # Post the data to the API
+            resp = self._send("POST", full_url, data)
 
-            #If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
-            if resp.status_code != 200:
+            # If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
+            if resp.status_code not in ApiClient.SUCCESS_CODE:
                 if attempts == 1:
-                    print("Warning: Threat Stack API returned a {}! (tried {} time)".format(resp.status_code, attempts))
+                    print(
+                        "Warning: Threat Stack API returned a {}! (tried {} time)".format(
+                            resp.status_code, attempts
+                        )
+                    )
                 else:
-                    print("Warning: Threat Stack API returned a {}! (tried {} times)".format(resp.status_code, attempts))
+                    print(
+                        "Warning: Threat Stack API returned a {}! (tried {} times)".format(
+                            resp.status_code, attempts
+                        )
+                    )
                 if attempts == self.retry:
                     print("Error: Max retries exceeded!")
                     handle_api_error(resp.status_code, resp.text)
                 else:
                     attempts += 1
 
-            #Else, format the response object and return it
+            # Else, format the response object and return it
             else:
-                resp_object = PostResponse(resp.status_code, resp.json())
+                resp_object = PostResponse(
+                    resp.status_code, resp.content, self.decoder, self.metrics
+                )
                 return resp_object
 
     def put(self, endpoint, data):
-        '''
+        """
         This method allows the user to make a PUT request to one of Threat Stack's Write API endpoints
         It takes required parameters of endpoint and data
-        '''
-        #Attempts tracks the number of times a request was attempted
+        """
+        # Attempts tracks the number of times a request was attempted
         attempts = 1
         while True:
-            #Build the full URL string
+            # Build the full URL string
             full_url = self.base_url + endpoint
 
-            #Post the data to the API
-            sender = Sender(self.credentials, full_url, 'PUT', always_hash_content = False, ext = self.org_id, content = data, content_type = 'application/json')
-            resp = requests.put(full_url, headers = {'Authorization': sender.request_header, 'Content-Type': 'application/json'}, timeout = self.timeout, data = data)
+            # Post the data to the API
+            resp = self._send("PUT", full_url, data)
 
-            #If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
-            if resp.status_code != 200:
+            # If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
+            if resp.status_code not in ApiClient.SUCCESS_CODE:
                 if attempts == 1:
-                    print("Warning: Threat Stack API returned a {}! (tried {} time)".format(resp.status_code, attempts))
+                    print(
+                        "Warning: Threat Stack API returned a {}! (tried {} time)".format(
+                            resp.status_code, attempts
+                        )
+                    )
                 else:
-                    print("Warning: Threat Stack API returned a {}! (tried {} times)".format(resp.status_code, attempts))
+                    print(
+                        "Warning: Threat Stack API returned a {}! (tried {} times)".format(
+                            resp.status_code, attempts
+                        )
+                    )
                 if attempts == self.retry:
                     print("Error: Max retries exceeded!")
                     handle_api_error(resp.status_code, resp.text)
                 else:
                     attempts += 1
 
-            #Else, format the response object and return it
+            # Else, format the response object and return it
             else:
-                resp_object = PutResponse(resp.status_code, resp.json())
+                resp_object = PutResponse(
+                    resp.status_code, resp.content, self.decoder, self.metrics
+                )
                 return resp_object
 
-    def delete(self, endpoint, data = None):
-        '''
+    def delete(self, endpoint, data=None):
+        """
         This method allows the user to make a DELETE request to one of Threat Stack's Write API endpoints
         It takes a required parameter of endpoint
-        '''
-        #Attempts tracks the number of times a request was attempted
+        """
+        # Attempts tracks the number of times a request was attempted
         attempts = 1
         while True:
-            #Build the full URL string
+            # Build the full URL string
             full_url = self.base_url + endpoint
 
-            #Post the data to the API
-            if data:
-                sender = Sender(self.credentials, full_url, 'DELETE', always_hash_content = False, ext = self.org_id, content = data, content_type = 'application/json')
-                resp = requests.delete(full_url, headers = {'Authorization': sender.request_header, 'Content-Type': 'application/json'}, timeout = self.timeout, data = data)
-            else:
-                sender = Sender(self.credentials, full_url, 'DELETE', always_hash_content = False, ext = self.org_id)
-                resp = requests.delete(full_url, headers = {'Authorization': sender.request_header}, timeout = self.timeout)
+            # Post the data to the API
+            resp = self._send("DELETE", full_url, data)
 
-            #If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
-            if resp.status_code != 200:
+            # If a non-200 response is returned, check attempts. If it exceeds retry, throw an error. Otherwise, try again
+            if resp.status_code not in ApiClient.SUCCESS_CODE:
                 if attempts == 1:
-                    print("Warning: Threat Stack API returned a {}! (tried {} time)".format(resp.status_code, attempts))
+                    print(
+                        "Warning: Threat Stack API returned a {}! (tried {} time)".format(
+                            resp.status_code, attempts
+                        )
+                    )
                 else:
-                    print("Warning: Threat Stack API returned a {}! (tried {} times)".format(resp.status_code, attempts))
+                    print(
+                        "Warning: Threat Stack API returned a {}! (tried {} times)".format(
+                            resp.status_code, attempts
+                        )
+                    )
                 if attempts == self.retry:
                     print("Error: Max retries exceeded!")
                     handle_api_error(resp.status_code, resp.text)
                 else:
                     attempts += 1
 
-        #Else, format the response object
-        else:
-            resp_object = DeleteResponse(resp.status_code, resp.json())
-            return resp_object
+            # Else, format the response object
+            else:
+                resp_object = DeleteResponse(
+                    resp.status_code, resp.content, self.decoder, self.metrics
+                )
+                return resp_object
+
+
+class RecordedResponse:
+    """
+    This class stands in for a requests response when a cassette is replayed
+    It carries the recorded status code and the exact recorded body
+    """
+
+    def __init__(self, status_code, content):
+        setattr(self, "status_code", status_code)
+        setattr(self, "content", content)
+
+    @property
+    def text(self):
+        return bytes(self.content).decode("utf-8", "replace")
+
+    def json(self):
+        return stdlib_loads(self.content)
+
 
 class Response:
-    '''
-    This is the parent class for the two types of responses
-    It contains all of the common properties and methods between the two
-    '''
-    def __init__(self, status_code):
-        setattr(self, 'status_code', status_code)
+    """
+    This is the parent class for all of the response types
+    It contains all of the common properties and methods between them
+    Responses keep the raw body in "content" and only decode it the first time
+    "data" is read, so callers that just want the bytes never pay for parsing
+    """
+
+    __slots__ = ("status_code", "content", "_decoder", "_metrics", "_decoded")
+
+    def __init__(self, status_code, content, decoder=stdlib_loads, metrics=None):
+        self.status_code = status_code
+        self.content = content
+        self._decoder = decoder
+        self._metrics = metrics
+        self._decoded = None
 
     def __str__(self):
         return "This is a response object from the Threat Stack API"
 
+    def _decode(self):
+        if self._decoded is None:
+            if self._metrics is not None:
+                self._decoded = decode_body(self._decoder, self.content, self._metrics)
+            else:
+                self._decoded = self._decoder(self.content)
+        return self._decoded
+
+    @property
+    def data(self):
+        # By default, "data" is the ENTIRE json response from the API
+        return self._decode()
+
 
 class ListResponse(Response):
-    '''
+    """
     This class defines the object that we will return from a request for a list of objects
     Its parent is the generic "Response" class, with the following changes:
         - It has an attribute "data", set to the VALUE of a key value pair where
         the value is of type "list"
         - It has an attribute "token", which is set to the page token
-    '''
-    def __init__(self, status_code, data):
-        #This is a child of the Response class, so call Response's init method
-        Response.__init__(self, status_code)
+    Both are pulled out of the body on first access
+    """
+
+    __slots__ = ("_data", "_token")
+
+    def __init__(self, status_code, content, decoder=stdlib_loads, metrics=None):
+        # This is a child of the Response class, so call Response's init method
+        Response.__init__(self, status_code, content, decoder, metrics)
+        self._data = None
+        self._token = None
+
+    def _split(self):
+        if self._data is not None:
+            return
 
-        #A list response should take the following form:
-        #{
+        # A list response should take the following form:
+        # {
         #    data: [list, of, data],
         #    token: (Either null or a token)
-        #}
-
-        #We expect there to only be 2 keys in the response. Raise an error if that's not the case
-        if len(data) > 2:
-            raise ValueError('Invalid list response from TS API: ' + str(data))
-
-        #We're going to iterate over the object, and attempt to pull out the main data, and the token
-        #If we can't find either, or if there is an unrecognized key in the response, we'll raise an error
-        for key in data:
-            if key == 'token':
-                setattr(self, 'token', data[key])
-            elif type(data[key]) is list:
-                setattr(self, 'data', data[key])
+        # }
+        body = self._decode()
+
+        # We expect there to only be 2 keys in the response. Raise an error if that's not the case
+        if len(body) > 2:
+            raise ValueError("Invalid list response from TS API: " + str(body))
+
+        # We're going to look at each key, and attempt to pull out the main data, and the token
+        # If we can't find either, or if there is an unrecognized key in the response, we'll raise an error
+        data = None
+        for key, value in body.items():
+            if key == "token" or key == "paginationToken":
+                self._token = value
+            elif type(value) is list:
+                data = value
             else:
-                raise ValueError('Unrecognized key in response: ' + str(data[key]))
+                raise ValueError("Unrecognized key in response: " + str(value))
+        if data is None:
+            raise ValueError("Invalid list response from TS API: " + str(body))
+        self._data = data
+
+    @property
+    def data(self):
+        self._split()
+        return self._data
+
+    @property
+    def token(self):
+        self._split()
+        return self._token
+
 
 class OneResponse(Response):
-    '''
+    """
     This class defines the object that we will return from a request of a single object
     Its parent is the generic Response class, with the following changes:
         - It has an attribute "data", set to the ENTIRE json response from the API
-    '''
-    def __init__(self, status_code, data):
-        #This is a child of the Response class, so call Response's init method
-        Response.__init__(self, status_code)
-
-        #At the moment, all we're doing with this class is returning the entire data set that we see
-        #We've made it its own class for the sake of consistency, and to aid in potential expansion
-        setattr(self, 'data', data)
+    """
 
+    # At the moment, all we're doing with this class is returning the entire data set that we see
+    # We've made it its own class for the sake of consistency, and to aid in potential expansion
+    __slots__ = ()
 
 
 class PostResponse(Response):
-    '''
+    """
     This class defines the object we will return from a POST request
     Its parent is the generic Response class, with the following changes:
         - It has an attribute "data", set to the ENTIRE json response from the API
-    '''
-    def __init__(self, status_code, data):
-        Response.__init__(self, status_code)
+    """
+
+    __slots__ = ()
 
-        #At the moment, all we're doing with this class is returning the entire data set returned by a POST endpoint
-        #We've made it its own class for the sake of consistency, and to aid in potential expansion
-        setattr(self, 'data', data)
 
 class PutResponse(Response):
-    '''
+    """
     This class defines the object we will return from a PUT request
     Its parent is the generic Response class, with the following changes:
         - It has an attribute "data", set to the ENTIRE json response from the API
-    '''
-    def __init__(self, status_code, data):
-        Response.__init__(self, status_code)
+    """
+
+    __slots__ = ()
 
-        #At the moment, all we're doing with this class is returning the entire data set returned by a PUT endpoint
-        #We've made it its own class for the sake of consistency, and to aid in potential expansion
-        setattr(self, 'data', data)
 
 class DeleteResponse(Response):
-    '''
+    """
     This class defines the object we will return from a DELETE request
     Its parent is the generic Response class, with the following changes:
-        - It has an attribute "data", set to the ENTIRE json response from the API
-    '''
-    def __init__(self, status_code, data):
-        Response.__init__(self, status_code)
+        - It has an attribute "data", set to the ENTIRE json response from the API,
+        or to the (empty) response text for a 204
+    """
+
+    __slots__ = ()
+
+    @property
+    def data(self):
+        if self.status_code == 204:
+            return bytes(self.content).decode("utf-8")
+        return self._decode()
+
+
+def build_list_url(base_url, endpoint, query_string="", token=""):
+    """
+    Build the full URL for a list request, appending the page token if it's defined
+    """
+    full_url = base_url + endpoint + query_string
+    if token:
+        if "?" in full_url:
+            full_url = full_url + "&token=" + token
+        else:
+            full_url = full_url + "?token=" + token
+    return full_url
+
+
+def request_signature(method, full_url, data=None):
+    """
+    Build the key a recorded response is stored and looked up under
+    Requests with a body are told apart by a hash of the body
+    """
+    if data:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return method + " " + full_url + " " + hashlib.sha256(data).hexdigest()
+    return method + " " + full_url
+
+
+def recorded_query(archive_path, endpoint):
+    """
+    Return the query parameters of the first request to endpoint recorded in an
+    archive or cassette, as the raw strings that were sent, or None
+
+    Exporters whose query depends on the clock, such as an alert time range,
+    reuse them on replay so the recorded URLs match again
+    """
+    with open(archive_path + ".idx") as index:
+        for line in index:
+            if not line.strip():
+                continue
+            url = json.loads(line)["url"]
+            path, _, query = url.partition("?")
+            if path.endswith("/" + endpoint):
+                return dict(
+                    param.partition("=")[::2] for param in query.split("&") if param
+                )
+    return None
+
+
+def open_client(
+    user_id,
+    org_id,
+    api_key,
+    retry=5,
+    archive_path=None,
+    replay_path=None,
+    cassette_path=None,
+    cassette_mode="replay",
+    replay_latency=None,
+    **client_args
+):
+    """
+    Build the client an exporter should use
+    With replay_path the exporter is re-driven from a response archive instead of the API,
+    with archive_path every response the API returns is also copied to an archive
+    With cassette_path the client records to, or replays from, a cassette
+    Any other keyword arguments (pool_size, rate_limit, ...) are passed on to ApiClient
+    """
+    if replay_path:
+        return ArchiveReader(replay_path)
+
+    archive = None
+    if archive_path:
+        archive = ResponseArchive(archive_path)
+
+    return ApiClient(
+        user_id=user_id,
+        org_id=org_id,
+        api_key=api_key,
+        retry=retry,
+        archive=archive,
+        cassette=cassette_path,
+        cassette_mode=cassette_mode,
+        replay_latency=replay_latency,
+        **client_args
+    )
+
+
+class ResponseArchive:
+    """
+    This class defines an append-only archive of raw API responses
+    Response bodies are appended to the archive file exactly as the API returned them,
+    and one JSON line per response is appended to <path>.idx with the request method and url,
+    the status code, and the offset and length of the body in the archive file
+    When used as a cassette the request signature and the time the request took are kept too
+    With truncate, an existing archive is started over instead of appended to
+    """
+
+    def __init__(self, path, truncate=False):
+        setattr(self, "path", path)
+        setattr(self, "index_path", path + ".idx")
+        self._data = open(path, "wb" if truncate else "ab")
+        self._index = open(self.index_path, "w" if truncate else "a")
+        self._lock = threading.Lock()
+
+    def append(self, method, url, status_code, content, signature=None, elapsed=None):
+        # The body is written as-is, there is no decoding or reserialization
+        with self._lock:
+            offset = self._data.tell()
+            self._data.write(content)
+            self._data.flush()
+            entry = {
+                "offset": offset,
+                "length": len(content),
+                "status": status_code,
+                "method": method,
+                "url": url,
+                "fetchedAt": time.time(),
+            }
+            if signature is not None:
+                entry["signature"] = signature
+            if elapsed is not None:
+                entry["elapsed"] = elapsed
+            self._index.write(json.dumps(entry) + "\n")
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._index.close()
+
+
+class ArchiveReader:
+    """
+    This class defines the read side of a ResponseArchive
+    The archive file is memory-mapped and bodies are sliced out of it by offset
+    It exposes get_list and get_one like ApiClient, so an exporter's transform stage can be
+    re-driven from the archive without making any API calls
+    """
+
+    def __init__(self, path, base_url="https://api.threatstack.com/v2/", decoder=None):
+        setattr(self, "path", path)
+        setattr(self, "base_url", base_url)
+        setattr(self, "entries", [])
+        setattr(self, "decoder", decoder or default_decoder())
+        setattr(self, "metrics", new_metrics())
+
+        with open(path + ".idx") as index:
+            for line in index:
+                if line.strip():
+                    self.entries.append(json.loads(line))
+
+        if os.path.getsize(path):
+            with open(path, "rb") as f:
+                self._map = memoryview(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                )
+        else:
+            self._map = memoryview(b"")
+
+        # Repeats of the same request are served in the order they were recorded
+        self._by_request = {}
+        for entry in self.entries:
+            signature = entry.get("signature") or request_signature(
+                entry["method"], entry["url"]
+            )
+            self._by_request.setdefault(signature, []).append(entry)
+        self._served = {}
+        self._lock = threading.Lock()
+
+    def body(self, entry):
+        """
+        Return the raw body recorded for an index entry
+        This is a memoryview into the mapped archive, nothing is copied
+        """
+        return self._map[entry["offset"] : entry["offset"] + entry["length"]]
+
+    def _lookup(self, method, full_url, data=None):
+        key = request_signature(method, full_url, data)
+        entries = self._by_request.get(key)
+        if not entries:
+            raise ThreatStackNotFoundError(404, "No archived response for " + key)
+
+        with self._lock:
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        return entries[min(served, len(entries) - 1)]
+
+    def replay(self, method, full_url, data=None, latency=None):
+        """
+        Serve a recorded exchange back to ApiClient in place of a live request
+        latency can be a number of seconds to wait, or "recorded" to wait as long as the original request took
+        """
+        entry = self._lookup(method, full_url, data)
+        if latency == "recorded":
+            time.sleep(entry.get("elapsed", 0))
+        elif latency:
+            time.sleep(latency)
+        return RecordedResponse(entry["status"], self.body(entry))
+
+    def get_list(self, endpoint, query_string="", token=""):
+        full_url = build_list_url(self.base_url, endpoint, query_string, token)
+        entry = self._lookup("GET", full_url)
+        return ListResponse(
+            entry["status"], self.body(entry), self.decoder, self.metrics
+        )
+
+    def get_one(self, endpoint, query_string=""):
+        entry = self._lookup("GET", self.base_url + endpoint + query_string)
+        return OneResponse(
+            entry["status"], self.body(entry), self.decoder, self.metrics
+        )
 
-        #At the moment, all we're doing with this class is returning the entire data set returned by a DELETE endpoint
-        #We've made it its own class for the sake of consistency, and to aid in potential expansion
-        setattr(self, 'data', data)
 
 def handle_api_error(status_code, response):
-    #We're going to use a dictionary mapping like a switch statement to throw the correct error
+    # We're going to use a dictionary mapping like a switch statement to throw the correct error
     error_switcher = {
-            400: ThreatStackBadRequestError(status_code, response),
-            401: ThreatStackUnauthorizedError(status_code, response),
-            403: ThreatStackForbiddenError(status_code, response),
-            404: ThreatStackNotFoundError(status_code, response),
-            409: ThreatStackConflictError(status_code, response),
-            429: ThreatStackRateLimitError(status_code, response),
-            500: ThreatStackInternalError(status_code, response)
-            }
+        400: ThreatStackBadRequestError(status_code, response),
+        401: ThreatStackUnauthorizedError(status_code, response),
+        403: ThreatStackForbiddenError(status_code, response),
+        404: ThreatStackNotFoundError(status_code, response),
+        409: ThreatStackConflictError(status_code, response),
+        429: ThreatStackRateLimitError(status_code, response),
+        500: ThreatStackInternalError(status_code, response),
+    }
     raise error_switcher.get(status_code, ThreatStackAPIError(status_code, response))
 
+
 class ThreatStackAPIError(Exception):
-    '''
+    """
     This is the parent class for all errors returned by the API.
     Ideally, this will never be thrown directly, but will be thrown if an otherwise unrecognized error is returned by the API
-    '''
+    """
+
     def __init__(self, status_code, response):
-        self.expression = 'Threat Stack returned a ' + str(status_code) + ' error'
+        self.expression = "Threat Stack returned a " + str(status_code) + " error"
         self.message = response
-        super().__init__(self.expression + ': ' +  self.message)
+        super().__init__(self.expression + ": " + self.message)
+
 
 class ThreatStackBadRequestError(ThreatStackAPIError):
-    '''
+    """
     This error reflects a problem with the format of your query
     It likely means that the user has an issue with the parameters of the request
     This will be thrown if a request returns a 400 status
-    '''
+    """
+
     def __init__(self, status_code, response):
         ThreatStackAPIError.__init__(self, status_code, response)
 
+
 class ThreatStackUnauthorizedError(ThreatStackAPIError):
-    '''
+    """
     This error reflects a problem with authenticating against the API.
     It likely means that you've submitted your credentials incorrectly
     This will be thrown if a request returns a 401 status
-    '''
+    """
+
     def __init__(self, status_code, response):
         ThreatStackAPIError.__init__(self, status_code, response)
 
+
 class ThreatStackForbiddenError(ThreatStackAPIError):
-    '''
+    """
     This error reflects the user in the request not having permission to complete the desired action.
     It likely means that you submitted your credentials correctly, but the user ID you used doesn't have permission to complete the desired action
     This will be thrown if a request returns a 403 status
-    '''
+    """
+
     def __init__(self, status_code, response):
         ThreatStackAPIError.__init__(self, status_code, response)
 
+
 class ThreatStackNotFoundError(ThreatStackAPIError):
-    '''
+    """
     This error reflects a problem with finding the requested resource.
     It likely means a resource you requested doesn't exist, or is misnamed
     This will be thrown if a request returns a 404 status
-    '''
+    """
+
     def __init__(self, status_code, response):
         ThreatStackAPIError.__init__(self, status_code, response)
 
+
 class ThreatStackConflictError(ThreatStackAPIError):
-    '''
+    """
     This error reflects a problem with the request conflicting with the existing state
     This likely means you're trying to create a resource that already exists, or similar
     This will be thrown if a request returns a 409
-    '''
+    """
+
     def __init__(self, status_code, response):
         ThreatStackAPIError.__init__(self, status_code, response)
 
+
 class ThreatStackRateLimitError(ThreatStackAPIError):
-    '''
+    """
     This error reflects a problem with the number of requests the usre has submitted over a short period of time
     It likely means that the user has submitted too many requests
     This will be thrown if a request returns a 429 status
-    '''
+    """
+
     def __init__(self, status_code, response):
         ThreatStackAPIError.__init__(self, status_code, response)
 
+
 class ThreatStackInternalError(ThreatStackAPIError):
-    '''
+    """
     This error reflects an internal problem with Threat Stack itself
     It likely means that the user made a valid request, but something is broken on Threat Stack's end
     This will be thrown if a request returns a 500 error
-    '''
+    """
+
     def __init__(self, status_code, response):
         ThreatStackAPIError.__init__(self, status_code, response)
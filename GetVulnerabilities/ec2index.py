@@ -0,0 +1,218 @@
+#   Copyright (c) 2022 F5, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+    Shared EC2 agent index for the Threat Stack export scripts
+
+    The index maps the agent id of each monitored instance to a fixed set of
+    instance fields. Whichever exporter pages through aws/ec2 first saves it
+    to a file, and the others memory-map that file instead of paging through
+    the inventory again, until it is older than their TTL.
+
+    File layout:
+        records   one JSON array of field values per instance
+        keys      the agent ids, UTF-8 encoded
+        table     one (key offset, key length, record offset, record length)
+                  entry per instance, sorted by agent id
+        footer    JSON with the columns, build time, count and table offset
+        8 bytes   offset of the footer
+"""
+
+import functools
+import json
+import mmap
+import os
+import struct
+import time
+
+
+# Instance fields kept in the index, in the order they are stored
+INDEX_COLUMNS = [
+    "id",
+    "kernelId",
+    "instanceType",
+    "privateDnsName",
+    "privateIpAddress",
+    "groups",
+    "subnetId",
+    "keyName",
+    "region",
+    "launchTime",
+    "imageId",
+    "architecture",
+    "publicDnsName",
+    "publicIpAddress",
+    "vpcId",
+    "awsProfile",
+    "monitored",
+    "tags",
+    "state",
+    "stateCode",
+]
+
+ENTRY = struct.Struct(">QIQI")
+FOOTER_OFFSET = struct.Struct(">Q")
+
+
+def add_servers(entries, servers, columns=INDEX_COLUMNS):
+    """
+    Add a page of raw aws/ec2 instances to an agent id -> field tuple dict
+    Instances without an agent are skipped
+    """
+    for server in servers:
+        if server.get("agents"):
+            entries[server["agents"][0]["id"]] = tuple(
+                server.get(name) for name in columns
+            )
+
+
+def write_index(path, entries, columns=INDEX_COLUMNS):
+    """
+    Save an agent id -> field tuple dict as an index file
+    The file is written next to path and then moved over it, so readers
+    never see a partial index
+    """
+    tmp_path = path + ".tmp"
+    keys = sorted(entries)
+    with open(tmp_path, "wb") as f:
+        records = []
+        for key in keys:
+            record = json.dumps(entries[key], separators=(",", ":"), default=str)
+            record = record.encode("utf-8")
+            records.append((f.tell(), len(record)))
+            f.write(record)
+
+        table = []
+        for key, (record_offset, record_length) in zip(keys, records):
+            encoded = key.encode("utf-8")
+            table.append(
+                ENTRY.pack(f.tell(), len(encoded), record_offset, record_length)
+            )
+            f.write(encoded)
+
+        table_offset = f.tell()
+        f.write(b"".join(table))
+
+        footer_offset = f.tell()
+        footer = {
+            "columns": list(columns),
+            "built": time.time(),
+            "count": len(keys),
+            "table": table_offset,
+        }
+        f.write(json.dumps(footer).encode("utf-8"))
+        f.write(FOOTER_OFFSET.pack(footer_offset))
+    os.replace(tmp_path, path)
+
+
+def read_footer(path):
+    """
+    Return the footer of an index file, or None if there is no valid index at path
+    """
+    if not os.path.isfile(path) or os.path.getsize(path) < FOOTER_OFFSET.size:
+        return None
+    with open(path, "rb") as f:
+        f.seek(-FOOTER_OFFSET.size, os.SEEK_END)
+        end = f.tell()
+        (footer_offset,) = FOOTER_OFFSET.unpack(f.read(FOOTER_OFFSET.size))
+        if footer_offset > end:
+            return None
+        f.seek(footer_offset)
+        try:
+            return json.loads(f.read(end - footer_offset))
+        except ValueError:
+            return None
+
+
+def is_fresh(path, ttl_hours, columns=INDEX_COLUMNS):
+    """
+    Return True if path holds an index with these columns, built less than ttl_hours ago
+    """
+    if not path:
+        return False
+    footer = read_footer(path)
+    if footer is None or footer["columns"] != list(columns):
+        return False
+    return time.time() - footer["built"] < ttl_hours * 3600
+
+
+class EC2Index:
+    """
+    This class defines the read side of an index file
+    The file is memory-mapped and looked up by binary search over the sorted
+    table, so opening it costs the same whatever the size of the inventory.
+    It can be used like the agent id -> field tuple dict it was built from.
+    """
+
+    def __init__(self, path, cache_size=65536):
+        footer = read_footer(path)
+        if footer is None:
+            raise ValueError("Not an EC2 index: " + str(path))
+
+        self.path = path
+        self.columns = footer["columns"]
+        self.built = footer["built"]
+        self.count = footer["count"]
+
+        with open(path, "rb") as f:
+            self._map = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        self._table = footer["table"]
+
+        # Vulnerabilities and alerts hit the same few agents over and over
+        self._lookup = functools.lru_cache(maxsize=cache_size)(self._find)
+
+    def _entry(self, position):
+        return ENTRY.unpack_from(self._map, self._table + position * ENTRY.size)
+
+    def _key(self, entry):
+        return bytes(self._map[entry[0] : entry[0] + entry[1]])
+
+    def _record(self, entry):
+        return tuple(json.loads(bytes(self._map[entry[2] : entry[2] + entry[3]])))
+
+    def _find(self, agent_id):
+        key = str(agent_id).encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entry = self._entry(middle)
+            found = self._key(entry)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return self._record(entry)
+        return None
+
+    def get(self, agent_id, default=None):
+        found = self._lookup(agent_id)
+        if found is None:
+            return default
+        return found
+
+    def __contains__(self, agent_id):
+        return self._lookup(agent_id) is not None
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        """
+        Yield (agent id, field tuple) for every instance, in agent id order
+        """
+        for position in range(self.count):
+            entry = self._entry(position)
+            yield self._key(entry).decode("utf-8"), self._record(entry)
+
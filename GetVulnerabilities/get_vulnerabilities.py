@@ -23,14 +23,65 @@
 import argparse
 import configparser
 from datetime import date
+import gzip
+import heapq
+import json
 import os
+import queue
 import re
 import sys
-import time
+import tempfile
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas
 
+import ec2index
 import threatstack
+import tsoutput
+
+
+AGENTS_MODES = ["long", "grouped"]
+
+# Vulnerability columns, as returned by the API, plus the agentId they are joined on
+# In long mode, agents holds the one agent of the row
+VULN_COLUMNS = [
+    "cveNumber",
+    "reportedPackage",
+    "systemPackage",
+    "vectorType",
+    "severity",
+    "isSuppressed",
+    "securityNotices",
+    "agents",
+    "agentId",
+]
+
+# EC2 instance columns joined to each vulnerability, or written to the host table
+HOST_COLUMNS = ec2index.INDEX_COLUMNS
+
+# Grouped mode writes one row per vulnerability with the ids of every affected agent
+GROUPED_COLUMNS = VULN_COLUMNS[:7] + ["agentIds", "agentCount"]
+
+# Severities from most to least severe, for ranking the summary
+SEVERITIES = ["critical", "high", "medium", "low", "negligible", "unknown"]
+
+# Filters that can be pushed into the vulnerabilities query string: field -> query
+# parameter, most selective first. Only the first one given is pushed down, one
+# cursor per value, and the rest are applied as the pages arrive. A vulnerability
+# lists every agent it affects, so agent cursors would overlap and the agent
+# filter is never pushed down
+FILTER_PARAMS = {
+    "cveNumber": "cveNumber",
+    "reportedPackage": "reportedPackage",
+    "severity": "severity",
+}
+
+# Columns of the day-over-day delta
+DELTA_COLUMNS = ["change", "cveNumber", "reportedPackage", "agentId"]
+
+# Vulnerabilities without a matching instance get empty host columns
+NO_HOST = ("",) * len(HOST_COLUMNS)
 
 
 def get_args():
@@ -68,11 +119,170 @@ def get_args():
         default=False,
     )
 
+    parser.add_argument(
+        "--severity",
+        dest="severities",
+        nargs="+",
+        choices=SEVERITIES,
+        help="Only pull vulns with these severities.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--package",
+        dest="packages",
+        nargs="+",
+        help="Only pull vulns in these reported packages.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cve",
+        dest="cves",
+        nargs="+",
+        help="Only pull these CVE numbers.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--agent-id",
+        dest="agents",
+        nargs="+",
+        help="Only keep these agents on each vuln, and the vulns affecting at least one of them.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--shard-workers",
+        dest="shard_workers",
+        type=int,
+        help="Maximum number of filter cursors fetched at once (default 4).",
+        required=False,
+        default=4,
+    )
+
+    parser.add_argument(
+        "--host-table",
+        dest="host_table",
+        action="store_true",
+        help="Write the EC2 instance columns once per agent to a separate Hosts file keyed by agentId, instead of on every vulnerability.",
+        required=False,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--agents-mode",
+        dest="agents_mode",
+        choices=AGENTS_MODES,
+        help="long (default) writes one row per vulnerability and affected agent, joined to its EC2 instance. grouped writes one row per vulnerability with the list of affected agent ids.",
+        required=False,
+        default="long",
+    )
+
+    parser.add_argument(
+        "--summary",
+        dest="summary",
+        action="store_true",
+        help="Instead of exporting every vulnerability, write small ranked tables of affected agents per CVE, per package and per AWS profile and region.",
+        required=False,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--keys",
+        dest="keys_file",
+        help="Sorted file of the (cve, package, agentId) keys of the previous run. New and resolved keys since then are written to a VulnDelta file, then this file is replaced with this run's keys.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--delta-only",
+        dest="delta_only",
+        action="store_true",
+        help="With --keys, only write the delta and skip the full export.",
+        required=False,
+        default=False,
+    )
+
+    parser.add_argument(
+        "--ec2-index",
+        dest="ec2_index",
+        help="Shared EC2 agent index file. A fresh one is used instead of paging through the EC2 inventory, otherwise it is rebuilt from this run's inventory.",
+        required=False,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--ec2-index-ttl-hours",
+        dest="ec2_index_ttl",
+        type=float,
+        help="Rebuild the EC2 index once it is this old (default 24).",
+        required=False,
+        default=24,
+    )
+
+    parser.add_argument(
+        "--checkpoint",
+        dest="checkpoint",
+        help="Save progress to this file after every page, and resume from it if it already exists. Not available with --format parquet.",
+        required=False,
+        default=None,
+    )
+
+    tsoutput.add_output_args(parser, tsoutput.SCHEMA_FORMATS)
+    tsoutput.add_archive_args(parser)
+
     cli_args = parser.parse_args()
 
     config_file = cli_args.config_file
     org_config = cli_args.org_config
     notices = cli_args.notices
+    host_table = cli_args.host_table
+    agents_mode = cli_args.agents_mode
+    summary = cli_args.summary
+    checkpoint_file = cli_args.checkpoint
+    if checkpoint_file and cli_args.output_format == "parquet":
+        print("--checkpoint can't be used with --format parquet, exiting.")
+        sys.exit(-1)
+    if checkpoint_file and summary:
+        print("--checkpoint can't be used with --summary, exiting.")
+        sys.exit(-1)
+    diff_opts = (cli_args.keys_file, cli_args.delta_only)
+    index_opts = (cli_args.ec2_index, cli_args.ec2_index_ttl)
+    filter_opts = (
+        cli_args.severities,
+        cli_args.packages,
+        cli_args.cves,
+        cli_args.agents,
+        cli_args.shard_workers,
+    )
+    # A checkpoint holds the token of a single cursor, and only the first of
+    # --cve, --package and --severity given is fetched as one cursor per value
+    pushed_values = cli_args.cves or cli_args.packages or cli_args.severities or []
+    if checkpoint_file and len(set(pushed_values)) > 1:
+        print(
+            "--checkpoint can only be used with one value of the first of --cve, --package and --severity given, exiting."
+        )
+        sys.exit(-1)
+    if cli_args.delta_only and not cli_args.keys_file:
+        print("--delta-only needs a --keys file, exiting.")
+        sys.exit(-1)
+    if cli_args.keys_file and (checkpoint_file or summary):
+        print("--keys can't be used with --checkpoint or --summary, exiting.")
+        sys.exit(-1)
+    output_opts = (cli_args.output_format, cli_args.compression, cli_args.rotate_mb)
+    archive_opts = (
+        cli_args.archive_path,
+        cli_args.replay_path,
+        cli_args.cassette_path,
+        cli_args.cassette_mode,
+        cli_args.replay_latency,
+    )
 
     if not os.path.isfile(config_file):
         print("Unable to find config file: " + config_file + ", exiting.")
@@ -108,7 +318,22 @@ def get_args():
     tmp_org_name = re.sub("[\W_]+", "_", org_opts["TS_ORGANIZATION_NAME"])
     org_name = re.sub("[^A-Za-z0-9]+", "", tmp_org_name)
 
-    return user_id, api_key, org_id, org_name, notices
+    return (
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        notices,
+        output_opts,
+        archive_opts,
+        host_table,
+        checkpoint_file,
+        agents_mode,
+        summary,
+        diff_opts,
+        index_opts,
+        filter_opts,
+    )
 
 
 def print_parsed_args(user_id, api_key, org_id, org_name, notices):
@@ -130,10 +355,31 @@ def print_parsed_args(user_id, api_key, org_id, org_name, notices):
     print("notices: " + str(notices))
 
 
-def get_vulnerabilities(userid, apikey, orgid, org_name, notices):
+def get_vulnerabilities(
+    userid,
+    apikey,
+    orgid,
+    org_name,
+    notices,
+    output_opts=("csv", "gzip", 0),
+    archive_opts=(None, None, None, "replay", None),
+    host_table=False,
+    checkpoint_file=None,
+    agents_mode="long",
+    summary=False,
+    diff_opts=(None, False),
+    index_opts=(None, 24),
+    filter_opts=(None, None, None, None, 4),
+):
     """
     This function is used to get all the vulnerabilities for a specfic org
-    This is then writen out to a csv file
+    Vulnerabilities are joined to their EC2 instance and streamed out page by
+    page, to CSV, JSON lines or Parquet
+    The EC2 and vulnerability cursors are paged through at the same time. A
+    vulnerability whose instance hasn't arrived yet is held back until the
+    EC2 side is complete
+    With a checkpoint file, progress is saved after every page and an
+    interrupted run picks up from the last saved page
 
     Parameters:
     user_id (str) : User id used for Threat Stack API
@@ -141,89 +387,792 @@ def get_vulnerabilities(userid, apikey, orgid, org_name, notices):
     org_id (str) : org id used for Threat Stack API
     org_name (str) : org name used for Threat Stack API
     notices (boolean) : whether to only get vulns with security notices
+    output_opts (tuple) : output format, compression and rotation size in MB
+    archive_opts (tuple) : response archive to write to and to replay from, and cassette settings
+    host_table (boolean) : write the instance columns to a separate host table keyed by agentId
+    checkpoint_file (str) : file to save progress to, and resume from if it exists
+    agents_mode (str) : 'long' for a row per vulnerability and agent, 'grouped'
+        for a row per vulnerability with its list of agent ids
+    summary (boolean) : write the ranked summary tables instead of every vulnerability
+    diff_opts (tuple) : key file of the previous run to diff against, and whether to only write the delta
+    index_opts (tuple) : shared EC2 index file and its TTL in hours
+    filter_opts (tuple) : severities, packages, CVE numbers and agent ids to keep,
+        and the maximum number of filter cursors fetched at once
     """
-    all_vulns = []
-    enhanced_vuln = None
-    ec2_servers = {}
+    output_format, compression, rotate_mb = output_opts
     timestamp = date.today().isoformat()
-    vulnfile = "Vulns" + "-" + org_name + "-" + timestamp + ".csv"
-    uaclient = threatstack.ApiClient(
-        user_id=userid, org_id=orgid, api_key=apikey, retry=5
+    # The rate limit replaces the old fixed sleep between EC2 pages. The EC2 and
+    # vulnerability cursors share it, so the total stays under 11 requests per second
+    uaclient = threatstack.open_client(
+        userid, orgid, apikey, 5, *archive_opts, rate_limit=11
     )
 
     # get vulns based on notices
     if notices == True:
         vuln_query_string = "vulnerabilities?status=active&hasSecurityNotices=true"
-        vulnfile = "Vulns" + "-" + org_name + "-SecurityNotices-" + timestamp + ".csv"
+        vulnfile = "Vulns" + "-" + org_name + "-SecurityNotices-" + timestamp
     else:
         vuln_query_string = "vulnerabilities?status=active"
-        vulnfile = "Vulns" + "-" + org_name + "-" + timestamp + ".csv"
+        vulnfile = "Vulns" + "-" + org_name + "-" + timestamp
+
+    severities, packages, cves, agents, shard_workers = filter_opts
+    vuln_filters = {}
+    for field, values in [
+        ("severity", severities),
+        ("reportedPackage", packages),
+        ("cveNumber", cves),
+        ("agentId", agents),
+    ]:
+        if values:
+            vuln_filters[field] = set(values)
+    vuln_cursors = build_vuln_queries(vuln_query_string, vuln_filters)
+    if len(vuln_cursors) > 1:
+        print("Fetching " + str(len(vuln_cursors)) + " filter cursors")
+
+    if summary:
+        get_vulnerability_summary(
+            uaclient,
+            page_vulns(uaclient, vuln_cursors, shard_workers),
+            vulnfile.replace("Vulns", "VulnSummary", 1),
+            index_opts,
+        )
+        return
+
+    keys_file, delta_only = diff_opts
+    deltafile = vulnfile.replace("Vulns", "VulnDelta", 1)
+    vuln_keys = None
+    if keys_file:
+        vuln_keys = VulnKeys()
+    if delta_only:
+        for vulns, token in page_vulns(uaclient, vuln_cursors, shard_workers):
+            vuln_keys.add_page(vulns)
+        print("API metrics: " + str(uaclient.metrics))
+        write_vuln_delta(vuln_keys, keys_file, deltafile, output_opts)
+        return
+
+    # A checkpoint is only resumed by the same export, into the same output
+    settings = [
+        [querystring for querystring, cursor_filters in vuln_cursors],
+        sorted(vuln_filters.get("agentId", [])),
+        output_format,
+        compression,
+        rotate_mb,
+        host_table,
+        agents_mode,
+    ]
+    checkpoint = tsoutput.load_checkpoint(checkpoint_file)
+    if checkpoint is not None:
+        if checkpoint["settings"] != settings:
+            print(
+                "Checkpoint "
+                + checkpoint_file
+                + " was saved with different options, exiting."
+            )
+            sys.exit(-1)
+        vulnfile = checkpoint["output"]
+        print(
+            "Resuming "
+            + vulnfile
+            + " after "
+            + str(checkpoint["writer"]["records"])
+            + " vulns"
+        )
+
+    # Grouped rows aren't joined, so the EC2 inventory is only needed there for the host table
+    ec2_servers = {}
+    ec2_pool = ThreadPoolExecutor(max_workers=1)
+    ec2_future = None
+    if agents_mode == "long" or host_table:
+        ec2_servers, ec2_future = start_ec2_hosts(uaclient, ec2_pool, index_opts)
+
+    if agents_mode == "grouped":
+        columns = GROUPED_COLUMNS
+    elif host_table:
+        columns = VULN_COLUMNS
+    else:
+        columns = VULN_COLUMNS + HOST_COLUMNS
+
+    # Held back rows go to a side file next to the output
+    pending = PendingRows(
+        vulnfile + "-pending.jsonl", checkpoint and checkpoint["pending"]
+    )
+    vuln_pages = []
+    if checkpoint is None:
+        vuln_pages = page_vulns(uaclient, vuln_cursors, shard_workers)
+    else:
+        if checkpoint["token"]:
+            vuln_pages = page_vulns(uaclient, vuln_cursors, token=checkpoint["token"])
+
+    with tsoutput.SchemaWriter(
+        vulnfile,
+        [(name, name) for name in columns],
+        output_format,
+        compression,
+        rotate_mb,
+        resume=checkpoint and checkpoint["writer"],
+    ) as writer:
+        for vulns, token in vuln_pages:
+            print("Adding vulns")
+
+            if vuln_keys is not None:
+                vuln_keys.add_page(vulns)
+
+            if agents_mode == "grouped":
+                writer.write_frame(group_agents(vulns))
+            elif host_table:
+                writer.write_frame(explode_agents(vulns))
+            else:
+                # Rows whose instance hasn't arrived yet wait for the EC2 side to
+                # complete. A failed EC2 fetch raises here, rather than counting as done
+                ec2_done = ec2_future is None or ec2_future.done()
+                if ec2_done and ec2_future is not None:
+                    ec2_future.result()
+                rows = explode_agents(vulns)
+                if not ec2_done:
+                    held = rows["agentId"].isin(
+                        [a for a in rows["agentId"].unique() if a not in ec2_servers]
+                    )
+                    pending.add_rows(rows[held])
+                    rows = rows[~held]
+                writer.write_frame(join_hosts(rows, ec2_servers))
+
+            # Held back rows aren't in the output yet, so the checkpoint keeps their side file
+            if checkpoint_file:
+                tsoutput.save_checkpoint(
+                    checkpoint_file,
+                    {
+                        "settings": settings,
+                        "output": vulnfile,
+                        "token": token,
+                        "pending": pending.checkpoint(),
+                        "writer": writer.checkpoint(),
+                    },
+                )
+
+        # Join whatever was waiting on the EC2 side in a final pass
+        if ec2_future is not None:
+            ec2_future.result()
+        ec2_pool.shutdown()
+        if pending.count:
+            print("Joining " + str(pending.count) + " held back vulns")
+            for rows in pending.frames():
+                writer.write_frame(join_hosts(rows, ec2_servers))
+        pending.remove()
+
+    if checkpoint_file and os.path.isfile(checkpoint_file):
+        os.remove(checkpoint_file)
+
+    if host_table:
+        hostfile = "Hosts" + "-" + org_name + "-" + timestamp
+        with tsoutput.SchemaWriter(
+            hostfile,
+            [(name, name) for name in ["agentId"] + HOST_COLUMNS],
+            output_format,
+            compression,
+            rotate_mb,
+        ) as hosts:
+            hosts.write_many(
+                dict(zip(HOST_COLUMNS, host), agentId=agent_id)
+                for agent_id, host in ec2_servers.items()
+            )
+        print("Wrote " + str(hosts.records) + " hosts to " + ", ".join(hosts.files))
+
+    print("API metrics: " + str(uaclient.metrics))
+    if writer.unexpected:
+        print("Vulnerability fields not exported: " + str(writer.unexpected))
+    print("Wrote " + str(writer.records) + " vulns to " + ", ".join(writer.files))
+
+    if vuln_keys is not None:
+        write_vuln_delta(vuln_keys, keys_file, deltafile, output_opts)
+
+
+class VulnSummary(object):
+    """
+    Compact accumulators for the vulnerability summary
+
+    Agent ids are numbered as they are first seen, so each CVE and package
+    only keeps a set of small integers. The AWS profile and region of each
+    agent are looked up once, when the tables are built.
+    """
+
+    def __init__(self):
+        self.agent_index = {}
+        self.findings = []
+        self.cves = {}
+        self.packages = {}
+
+    def _agent(self, agent_id):
+        index = self.agent_index.get(agent_id)
+        if index is None:
+            index = self.agent_index[agent_id] = len(self.findings)
+            self.findings.append(0)
+        return index
+
+    def add_page(self, vulns):
+        for vuln in vulns:
+            agents = [
+                self._agent(agent.get("agentId")) for agent in vuln.get("agents") or []
+            ]
+            for index in agents:
+                self.findings[index] += 1
+
+            cve = vuln.get("cveNumber")
+            package = vuln.get("reportedPackage")
+            rank = severity_rank(vuln)
+            entry = self.cves.get(cve)
+            if entry is None:
+                entry = self.cves[cve] = [rank, set(), set()]
+            entry[0] = min(entry[0], rank)
+            entry[1].update(agents)
+            entry[2].add(package)
+
+            entry = self.packages.get(package)
+            if entry is None:
+                entry = self.packages[package] = [set(), set()]
+            entry[0].update(agents)
+            entry[1].add(cve)
+
+    def cve_table(self):
+        table = pandas.DataFrame(
+            [
+                (cve, SEVERITIES[rank], rank, len(agents), len(packages))
+                for cve, (rank, agents, packages) in self.cves.items()
+            ],
+            columns=["cveNumber", "severity", "rank", "affectedAgents", "packages"],
+        )
+        table = table.sort_values(
+            ["rank", "affectedAgents", "cveNumber"], ascending=[True, False, True]
+        )
+        return table.drop(columns=["rank"])
+
+    def package_table(self):
+        table = pandas.DataFrame(
+            [
+                (package, len(agents), len(cves))
+                for package, (agents, cves) in self.packages.items()
+            ],
+            columns=["reportedPackage", "affectedAgents", "cves"],
+        )
+        return table.sort_values(
+            ["affectedAgents", "reportedPackage"], ascending=[False, True]
+        )
 
+    def account_table(self, ec2_servers):
+        profile_column = HOST_COLUMNS.index("awsProfile")
+        region_column = HOST_COLUMNS.index("region")
+        rows = []
+        for agent_id, index in self.agent_index.items():
+            host = ec2_servers.get(agent_id, NO_HOST)
+            profile = host[profile_column]
+            if isinstance(profile, dict):
+                profile = profile.get("id", profile.get("ID"))
+            rows.append((profile or "", host[region_column] or "", self.findings[index]))
+
+        table = pandas.DataFrame(rows, columns=["awsProfile", "region", "findings"])
+        table = table.groupby(["awsProfile", "region"], as_index=False).agg(
+            affectedAgents=("findings", "size"), findings=("findings", "sum")
+        )
+        return table.sort_values(
+            ["affectedAgents", "awsProfile", "region"], ascending=[False, True, True]
+        )
+
+
+class PendingRows(object):
+    """
+    Exploded vulnerability rows held back until the EC2 side is complete
+
+    Rows are appended to a JSON lines side file instead of being kept in
+    memory, so a checkpoint only needs the file's size. Resuming from that
+    state drops anything appended after the checkpoint.
+    """
+
+    def __init__(self, path, resume=None):
+        self.path = path
+        self.count = 0
+        if resume:
+            self._file = open(path, "r+b")
+            self._file.truncate(resume["offset"])
+            self._file.seek(resume["offset"])
+            self.count = resume["count"]
+        else:
+            self._file = open(path, "wb")
+
+    def add_rows(self, rows):
+        for row in rows.to_dict("records"):
+            line = json.dumps(row, separators=(",", ":"), default=str)
+            self._file.write(line.encode("utf-8") + b"\n")
+        self.count += len(rows)
+
+    def checkpoint(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        return {"offset": self._file.tell(), "count": self.count}
+
+    def frames(self, chunk_rows=100000):
+        """
+        Yield the held back rows as DataFrames of up to chunk_rows rows
+        """
+        self._file.flush()
+        with open(self.path, "rb") as f:
+            chunk = []
+            for line in f:
+                chunk.append(json.loads(line))
+                if len(chunk) >= chunk_rows:
+                    yield pandas.DataFrame(chunk, dtype=object)
+                    chunk = []
+            if chunk:
+                yield pandas.DataFrame(chunk, dtype=object)
+
+    def remove(self):
+        self._file.close()
+        os.remove(self.path)
+
+
+class VulnKeys(object):
+    """
+    Collects the (cve, package, agentId) key of every finding and hands them
+    back sorted and without duplicates
+
+    Each key is kept as its JSON encoded line, which is also how it is stored
+    in the key file, so keys from both runs compare the same way. Once
+    chunk_keys keys are buffered they are sorted and spilled to a temporary
+    file, and sorted_keys() merges the spilled runs back together.
+    """
+
+    def __init__(self, chunk_keys=1000000):
+        self.chunk_keys = chunk_keys
+        self._chunk = []
+        self._runs = []
+
+    def add_page(self, vulns):
+        for vuln in vulns:
+            cve = vuln.get("cveNumber")
+            package = vuln.get("reportedPackage")
+            for agent in vuln.get("agents") or []:
+                self._chunk.append(json.dumps([cve, package, agent.get("agentId")]))
+        if len(self._chunk) >= self.chunk_keys:
+            self._spill()
+
+    def _spill(self):
+        self._chunk.sort()
+        with tempfile.NamedTemporaryFile(
+            "w", suffix=".keys", delete=False, encoding="utf-8"
+        ) as f:
+            f.writelines(key + "\n" for key in self._chunk)
+        self._runs.append(f.name)
+        self._chunk = []
+
+    def sorted_keys(self):
+        self._chunk.sort()
+        runs = [open(path, encoding="utf-8") for path in self._runs]
+        try:
+            previous = None
+            merged = heapq.merge(
+                self._chunk, *[(line.rstrip("\n") for line in run) for run in runs]
+            )
+            for key in merged:
+                if key != previous:
+                    yield key
+                    previous = key
+        finally:
+            for run in runs:
+                run.close()
+            for path in self._runs:
+                os.remove(path)
+            self._runs = []
+
+
+def read_keys(keys_file):
+    """
+    Yield the keys of a sorted key file, or nothing if there is no such file
+    """
+    if not os.path.isfile(keys_file):
+        print("No previous key file at " + keys_file + ", every finding is new.")
+        return
+    with gzip.open(keys_file, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield line.rstrip("\n")
+
+
+def write_vuln_delta(vuln_keys, keys_file, DELTA_FILE, output_opts):
+    """
+    This function merges this run's sorted keys with the previous key file in
+    one pass, writing new and resolved findings to DELTA_FILE and this run's
+    keys to a new key file that then replaces the previous one
+
+    Parameters:
+    vuln_keys (VulnKeys) : this run's keys
+    keys_file (str) : sorted key file of the previous run
+    DELTA_FILE (str) : output file name (without extension) to write the delta to
+    output_opts (tuple) : output format, compression and rotation size in MB
+    """
+    output_format, compression, rotate_mb = output_opts
+    counts = {"new": 0, "resolved": 0, "persisting": 0}
+
+    def delta(change, key):
+        counts[change] += 1
+        cve, package, agent_id = json.loads(key)
+        return {
+            "change": change,
+            "cveNumber": cve,
+            "reportedPackage": package,
+            "agentId": agent_id,
+        }
+
+    def changes(previous, current, new_keys):
+        previous_key = next(previous, None)
+        for key in current:
+            new_keys.write(key + "\n")
+            while previous_key is not None and previous_key < key:
+                yield delta("resolved", previous_key)
+                previous_key = next(previous, None)
+            if previous_key == key:
+                counts["persisting"] += 1
+                previous_key = next(previous, None)
+            else:
+                yield delta("new", key)
+        while previous_key is not None:
+            yield delta("resolved", previous_key)
+            previous_key = next(previous, None)
+
+    tmp_keys = keys_file + ".tmp"
+    with gzip.open(tmp_keys, "wt", encoding="utf-8") as new_keys:
+        with tsoutput.SchemaWriter(
+            DELTA_FILE,
+            [(name, name) for name in DELTA_COLUMNS],
+            output_format,
+            compression,
+            rotate_mb,
+        ) as writer:
+            writer.write_many(
+                changes(read_keys(keys_file), vuln_keys.sorted_keys(), new_keys)
+            )
+    os.replace(tmp_keys, keys_file)
+
+    print("Findings since the last run: " + str(counts))
+    print("Wrote the delta to " + ", ".join(writer.files))
+
+
+def severity_rank(vuln):
+    severity = str(vuln.get("severity") or "unknown").lower()
+    if severity in SEVERITIES:
+        return SEVERITIES.index(severity)
+    return len(SEVERITIES) - 1
+
+
+def get_vulnerability_summary(
+    uaclient, vuln_pages, summary_base, index_opts=(None, 24)
+):
+    """
+    This function aggregates the vulnerabilities as they are paged through,
+    and writes ranked tables of affected agents to <summary_base>-cves.csv,
+    -packages.csv and -accounts.csv
+
+    Parameters:
+    uaclient (ApiClient) : client to make the requests with
+    vuln_pages (iterable) : (vulns, token) pages, from page_vulns
+    summary_base (str) : output file name (without suffix and extension)
+    index_opts (tuple) : shared EC2 index file and its TTL in hours
+    """
+    # The EC2 inventory is only needed for the account table at the end
+    with ThreadPoolExecutor(max_workers=1) as ec2_pool:
+        ec2_servers, ec2_future = start_ec2_hosts(uaclient, ec2_pool, index_opts)
+
+        vuln_summary = VulnSummary()
+        for vulns, token in vuln_pages:
+            vuln_summary.add_page(vulns)
+
+        if ec2_future is not None:
+            ec2_future.result()
+
+    print("API metrics: " + str(uaclient.metrics))
+
+    cves = vuln_summary.cve_table()
+    cves.to_csv(summary_base + "-cves.csv", index=False)
+    vuln_summary.package_table().to_csv(summary_base + "-packages.csv", index=False)
+    vuln_summary.account_table(ec2_servers).to_csv(
+        summary_base + "-accounts.csv", index=False
+    )
+
+    print(
+        str(len(cves))
+        + " CVEs on "
+        + str(len(vuln_summary.agent_index))
+        + " agents. Top CVEs:"
+    )
+    print(cves.head(10).to_string(index=False))
+
+
+def pushed_filter(vuln_filters):
+    """
+    This function returns the field pushed down to the query string, or None
+    """
+    for field in FILTER_PARAMS:
+        if vuln_filters.get(field):
+            return field
+    return None
+
+
+def build_vuln_queries(vuln_query_string, vuln_filters):
+    """
+    This function returns a (query string, filters) cursor per value of the
+    pushed down filter, e.g. one per CVE number
+
+    The filters of a cursor only hold its own value of the pushed down field,
+    and every value of the others. Each vulnerability has a single severity,
+    package and CVE number, so even if the API ignores the parameter, the
+    cursors never return the same vulnerability twice.
+    """
+    field = pushed_filter(vuln_filters)
+    if field is None:
+        return [(vuln_query_string, vuln_filters)]
+
+    vuln_cursors = []
+    for value in sorted(vuln_filters[field]):
+        querystring = (
+            vuln_query_string
+            + "&"
+            + FILTER_PARAMS[field]
+            + "="
+            + urllib.parse.quote(value)
+        )
+        vuln_cursors.append((querystring, dict(vuln_filters, **{field: {value}})))
+    return vuln_cursors
+
+
+def filter_vulns(vulns, vuln_filters):
+    """
+    This function drops the vulnerabilities of a page that don't match the filters
+
+    Pushed down filters are checked again, in case the API ignores a query
+    parameter. With an agent filter, each vulnerability only keeps the
+    selected agents, and is dropped if none of them are affected.
+    """
+    if not vuln_filters:
+        return vulns
+    kept = []
+    for vuln in vulns:
+        if "severity" in vuln_filters:
+            if SEVERITIES[severity_rank(vuln)] not in vuln_filters["severity"]:
+                continue
+        if any(
+            vuln.get(field) not in vuln_filters[field]
+            for field in ["reportedPackage", "cveNumber"]
+            if field in vuln_filters
+        ):
+            continue
+        if "agentId" in vuln_filters:
+            agents = [
+                agent
+                for agent in vuln.get("agents") or []
+                if agent.get("agentId") in vuln_filters["agentId"]
+            ]
+            if not agents:
+                continue
+            vuln = dict(vuln, agents=agents)
+        kept.append(vuln)
+    return kept
+
+
+def page_vulns(uaclient, vuln_cursors, workers=4, token=None):
+    """
+    This function yields the (vulns, token) of every page of the
+    vulnerability cursors, filtered by each cursor's own filters
+
+    A single cursor is paged through in order, starting after token if one
+    is given. Several cursors are paged through at once on up to workers
+    threads, and their pages are yielded as they arrive, with no token.
+    """
+    if len(vuln_cursors) == 1:
+        vuln_query_string, vuln_filters = vuln_cursors[0]
+        querystring = vuln_query_string
+        if token:
+            querystring = vuln_query_string + "&token=" + token
+        vuln_list = uaclient.get_list(querystring)
+        while vuln_list:
+            yield filter_vulns(vuln_list.data, vuln_filters), vuln_list.token
+            if vuln_list.token:
+                print("token is: " + vuln_list.token)
+                querystring = vuln_query_string + "&token=" + vuln_list.token
+                vuln_list = uaclient.get_list(querystring)
+            else:
+                vuln_list = None
+        return
+
+    # Each cursor hands its pages over through the queue, then None when it is done
+    pages = queue.Queue()
+
+    def fetch(vuln_query_string, vuln_filters):
+        try:
+            vuln_list = uaclient.get_list(vuln_query_string)
+            while vuln_list:
+                pages.put(filter_vulns(vuln_list.data, vuln_filters))
+                if vuln_list.token:
+                    querystring = vuln_query_string + "&token=" + vuln_list.token
+                    vuln_list = uaclient.get_list(querystring)
+                else:
+                    vuln_list = None
+        finally:
+            pages.put(None)
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(vuln_cursors))) as pool:
+        futures = [
+            pool.submit(fetch, querystring, vuln_filters)
+            for querystring, vuln_filters in vuln_cursors
+        ]
+        remaining = len(futures)
+        while remaining:
+            vulns = pages.get()
+            if vulns is None:
+                remaining -= 1
+            else:
+                yield vulns, None
+        for future in futures:
+            future.result()
+
+
+def explode_agents(vulns):
+    """
+    This function expands a page of vulnerabilities into one row per
+    (vulnerability, agent), with the row's agent id in agentId
+    Columns are kept as objects so integers with gaps aren't turned into floats
+    """
+    frame = pandas.DataFrame(vulns, dtype=object)
+    if "agents" not in frame:
+        frame["agents"] = None
+    frame = frame.explode("agents", ignore_index=True)
+    frame["agentId"] = frame["agents"].str.get("agentId")
+    return frame
+
+
+def group_agents(vulns):
+    """
+    This function turns a page of vulnerabilities into one row per
+    vulnerability, with the ids of all its agents in agentIds
+    """
+    frame = pandas.DataFrame(vulns, dtype=object)
+    if "agents" not in frame:
+        frame["agents"] = None
+    frame["agentIds"] = [
+        [agent.get("agentId") for agent in agents] if isinstance(agents, list) else []
+        for agents in frame["agents"]
+    ]
+    frame["agentCount"] = [len(agent_ids) for agent_ids in frame["agentIds"]]
+    return frame.drop(columns=["agents"])
+
+
+def join_hosts(rows, ec2_servers):
+    """
+    This function joins exploded vulnerability rows to the host columns of their agent
+    The host columns replace any vulnerability field of the same name
+    """
+    hosts = pandas.DataFrame(
+        [ec2_servers.get(agent_id, NO_HOST) for agent_id in rows["agentId"]],
+        columns=HOST_COLUMNS,
+        index=rows.index,
+        dtype=object,
+    )
+    rows = rows.drop(columns=[name for name in HOST_COLUMNS if name in rows])
+    return pandas.concat([rows, hosts], axis=1)
+
+
+def start_ec2_hosts(uaclient, ec2_pool, index_opts=(None, 24)):
+    """
+    This function returns the agent id -> host columns lookup, and the future
+    filling it in the background, if any
+
+    A fresh shared EC2 index is memory-mapped and used as it is. Otherwise the
+    inventory is paged through on ec2_pool into a dict, which is saved as the
+    new index once it is complete.
+    """
+    index_file, index_ttl = index_opts
+    if ec2index.is_fresh(index_file, index_ttl):
+        ec2_servers = ec2index.EC2Index(index_file)
+        print(
+            "Using EC2 index " + index_file + " (" + str(len(ec2_servers)) + " agents)"
+        )
+        return ec2_servers, None
+
+    ec2_servers = {}
+    return ec2_servers, ec2_pool.submit(
+        get_ec2_hosts, uaclient, ec2_servers, index_file
+    )
+
+
+def get_ec2_hosts(uaclient, ec2_servers, index_file=None):
+    """
+    This function loads the monitored EC2 instances into ec2_servers, keyed by agent id
+
+    Only the HOST_COLUMNS of each instance are kept, as a tuple, and every
+    vulnerability on the same agent shares it. Instances are added page by
+    page, so the dict can be read while it is being filled. With an index
+    file, the complete dict is then saved as the shared EC2 index.
+    """
     ec2_query_string = "aws/ec2?monitored=true&verbose=true"
     ec2_server_list_data = uaclient.get_list(ec2_query_string)
-    vuln_list = uaclient.get_list(vuln_query_string)
 
     while ec2_server_list_data:
+        ec2index.add_servers(ec2_servers, ec2_server_list_data.data)
+
         if ec2_server_list_data.token:
             print("token is: '" + ec2_server_list_data.token + "'")
             ec2_query_string_token = (
                 ec2_query_string + "&token=" + ec2_server_list_data.token
             )
             print("query String is: '" + ec2_query_string_token + "'")
-            for server in ec2_server_list_data.data:
-                ec2_servers[server["agents"][0]["id"]] = server
-
             ec2_server_list_data = uaclient.get_list(ec2_query_string_token)
         else:
-            for server in ec2_server_list_data.data:
-                ec2_servers[server["agents"][0]["id"]] = server
             ec2_server_list_data = None
             print("token is blank")
-        time.sleep(0.09)
-
-    # print(ec2_servers)
 
-    while vuln_list:
-        print("Adding vulns")
-
-        for vuln in vuln_list.data:
-            # Add the agent id to the top level of the dictionary
-            vuln["agentId"] = vuln["agents"][0]["agentId"]
-            # print(vuln["agentId"])
-            # if vuln agent id is in ec2 servers add that to the enchanced_vulns
-            if vuln["agentId"] in ec2_servers:
-                server = ec2_servers[vuln["agentId"]]
-                enhanced_vuln = {**vuln, **server}
-
-            if enhanced_vuln is not None:
-                all_vulns.append(enhanced_vuln)
-                enhanced_vuln = None
-            else:
-                all_vulns.append(vuln)
-
-        if vuln_list.token:
-            print("token is: " + vuln_list.token)
-            querystring = vuln_query_string + "&token=" + vuln_list.token
-            vuln_list = uaclient.get_list(querystring)
-        else:
-            vuln_list = None
-        # Add all the vulns into pandas and convert to CSV
-
-    df = pandas.DataFrame(all_vulns)
-    df.to_csv(vulnfile, index=False)
-    # print(vul_list.data)
+    if index_file:
+        ec2index.write_index(index_file, ec2_servers)
+        print(
+            "Saved EC2 index " + index_file + " (" + str(len(ec2_servers)) + " agents)"
+        )
+    return ec2_servers
 
 
 def main():
 
     # Call GetArgs and get set the values for next function calls
-    user_id, api_key, org_id, org_name, notices = get_args()
+    (
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        notices,
+        output_opts,
+        archive_opts,
+        host_table,
+        checkpoint_file,
+        agents_mode,
+        summary,
+        diff_opts,
+        index_opts,
+        filter_opts,
+    ) = get_args()
 
     # Print out the ags
     print_parsed_args(user_id, api_key, org_id, org_name, notices)
 
     # Now go call getvulnerabilities to do it's api calls
-    get_vulnerabilities(user_id, api_key, org_id, org_name, notices)
+    get_vulnerabilities(
+        user_id,
+        api_key,
+        org_id,
+        org_name,
+        notices,
+        output_opts,
+        archive_opts,
+        host_table,
+        checkpoint_file,
+        agents_mode,
+        summary,
+        diff_opts,
+        index_opts,
+        filter_opts,
+    )
 
 
 if __name__ == "__main__":
@@ -33,6 +33,7 @@ import sys
 import json
 import pandas
 import threatstack
+import tsoutput
 
 
 class users(object):
@@ -96,10 +97,21 @@ def get_args():
         default="DEFAULT",
     )
 
+    tsoutput.add_output_args(parser)
+    tsoutput.add_archive_args(parser)
+
     cli_args = parser.parse_args()
 
     config_file = cli_args.config_file
     org_config = cli_args.org_config
+    output_opts = (cli_args.output_format, cli_args.compression, cli_args.rotate_mb)
+    archive_opts = (
+        cli_args.archive_path,
+        cli_args.replay_path,
+        cli_args.cassette_path,
+        cli_args.cassette_mode,
+        cli_args.replay_latency,
+    )
 
     if not os.path.isfile(config_file):
         print("Unable to find config file: " + config_file + ", exiting.")
@@ -135,7 +147,7 @@ def get_args():
     tmp_org_name = re.sub("[\W_]+", "_", org_opts["TS_ORGANIZATION_NAME"])
     org_name = re.sub("[^A-Za-z0-9]+", "", tmp_org_name)
 
-    return user_id, api_key, org_id, org_name
+    return user_id, api_key, org_id, org_name, output_opts, archive_opts
 
 
 def print_parsed_args(user_id, api_key, org_id, org_name):
@@ -155,7 +167,14 @@ def print_parsed_args(user_id, api_key, org_id, org_name):
     print("org_name: " + org_name)
 
 
-def get_users(userid, apikey, orgid, org_name):
+def get_users(
+    userid,
+    apikey,
+    orgid,
+    org_name,
+    output_opts=("csv", "gzip", 0),
+    archive_opts=(None, None, None, "replay", None),
+):
     """
     This function is used to get all the users for a specfic org
     The users are then writen out to a csv file
@@ -165,13 +184,14 @@ def get_users(userid, apikey, orgid, org_name):
     api_key (str) : Api Key used for Threat Stack API
     org_id (str) : org id used for Threat Stack API
     org_name (str) : org name used for Threat Stack API
+    output_opts (tuple) : output format, compression and rotation size in MB
+    archive_opts (tuple) : response archive to write to and to replay from, and cassette settings
 
     """
+    output_format, compression, rotate_mb = output_opts
     all_org_users = []
 
-    uaclient = threatstack.ApiClient(
-        user_id=userid, org_id=orgid, api_key=apikey, retry=5
-    )
+    uaclient = threatstack.open_client(userid, orgid, apikey, 5, *archive_opts)
 
     org_users = uaclient.get_list("organizations/members")
 
@@ -201,20 +221,23 @@ def get_users(userid, apikey, orgid, org_name):
             # print("Finished getting all users in: " + user["displayName"])
             org_users = None
 
-    allusersDF = pandas.DataFrame([x.__dict__ for x in all_org_users])
+    rulefile = org_name + "-All-Users-" + f"{datetime.datetime.now():%Y-%m-%d-%H-%M}"
 
-    rulefile = (
-        org_name + "-All-Users-" + f"{datetime.datetime.now():%Y-%m-%d-%H-%M}" + ".csv"
-    )
-    allusersDF.to_csv(rulefile, index=False)
+    if output_format == "jsonl":
+        with tsoutput.JsonlSink(rulefile, compression, rotate_mb) as sink:
+            sink.write_many(x.as_dict() for x in all_org_users)
+        return
+
+    allusersDF = pandas.DataFrame([x.__dict__ for x in all_org_users])
+    allusersDF.to_csv(rulefile + ".csv", index=False)
 
 
 def main():
     timestamp = f"{datetime.datetime.now():%Y-%m-%d-%H-%M}"
 
-    (user_id, api_key, org_id, org_name) = get_args()
+    (user_id, api_key, org_id, org_name, output_opts, archive_opts) = get_args()
     print_parsed_args(user_id, api_key, org_id, org_name)
-    get_users(user_id, api_key, org_id, org_name)
+    get_users(user_id, api_key, org_id, org_name, output_opts, archive_opts)
 
 
 if __name__ == "__main__":